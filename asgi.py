@@ -0,0 +1,9 @@
+# ASGI entry point: uvicorn asgi:app --port 2800
+#
+# The views stay synchronous and quick (they queue a trip and read its status). With PLANNER_RUNTIME=asyncio
+# the slow Claude and Arcade calls run on the planner's event loop, so no thread waits on them either.
+from a2wsgi import WSGIMiddleware
+
+from main import create_app
+
+app = WSGIMiddleware(create_app())
@@ -0,0 +1,88 @@
+# Benchmark: serial calendar writes vs. the bounded fan-out in add_calendar_events()
+#
+# Uses an in-process fake (async) Arcade client that sleeps to simulate each round trip,
+# so no Arcade account, API keys or network access are needed.
+# Usage: python benchmarks/bench_calendar_fanout.py [--events 25] [--latency 0.1] [--concurrency 8]
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+class FakeArcade:
+    """
+    Stands in for arcadepy.AsyncArcade: authorize, wait_for_completion and execute each sleep for `latency` seconds.
+    Every `fail_every`-th execute call raises, to exercise per-event error collection.
+    """
+    def __init__(self, latency, fail_every=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.executed = 0
+        self.tools = SimpleNamespace(authorize=self._authorize, execute=self._execute)
+        self.auth = SimpleNamespace(wait_for_completion=self._wait)
+
+    async def _authorize(self, tool_name, user_id):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(status="completed", url=None)
+
+    async def _wait(self, auth_response):
+        await asyncio.sleep(self.latency)
+        return auth_response
+
+    async def _execute(self, tool_name, input, user_id):
+        await asyncio.sleep(self.latency)
+        self.executed += 1
+        if self.fail_every and self.executed % self.fail_every == 0:
+            raise RuntimeError("injected Arcade failure")
+        return SimpleNamespace(output=SimpleNamespace(value="ok"))
+
+def make_events(count):
+    return [main.ItineraryEvent.from_dict({
+        "event_name": f"Event {i}",
+        "event_time": f"2030-01-0{1 + i % 5}T{8 + i % 12:02d}:00:00",
+        "event_price": "$10",
+        "event_address": f"{i} Main St",
+        "event_description": "Benchmark event",
+    }) for i in range(count)]
+
+async def serial_writes(client, events):
+    failures = 0
+    for event in events:
+        try:
+            await main.add_calendar_event(client, event, "bench@example.com")
+        except Exception:
+            failures += 1
+    return failures
+
+def main_benchmark():
+    main.configure()
+    parser = argparse.ArgumentParser(description="Calendar fan-out benchmark")
+    parser.add_argument("--events", type=int, default=25)
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds per fake Arcade round trip")
+    parser.add_argument("--concurrency", type=int, default=main.CALENDAR_CONCURRENCY)
+    parser.add_argument("--fail-every", type=int, default=0)
+    args = parser.parse_args()
+    events = make_events(args.events)
+
+    client = FakeArcade(args.latency, args.fail_every)
+    start = time.perf_counter()
+    serial_failures = asyncio.run(serial_writes(client, events))
+    serial = time.perf_counter() - start
+
+    client = FakeArcade(args.latency, args.fail_every)
+    start = time.perf_counter()
+    failures = asyncio.run(main.add_calendar_events(client, events, "bench@example.com", max_workers=args.concurrency))
+    fanout = time.perf_counter() - start
+
+    assert len(failures) == serial_failures, "fan-out must report the same failures as the serial loop"
+    print(f"events: {args.events}, latency: {args.latency * 1e3:.0f} ms, concurrency: {args.concurrency}")
+    print(f"serial loop: {serial:8.3f} s ({serial_failures} failed)")
+    print(f"fan-out:     {fanout:8.3f} s ({len(failures)} failed)")
+    print(f"speedup:     {serial / fanout:8.1f}x")
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,105 @@
+# Microbenchmark: shared CityIndex (parsed JSON and memory-mapped binary) vs. re-parsing cities.json on every validation,
+# plus autocomplete (prefix and fuzzy) latency on both indexes
+#
+# Usage: python benchmarks/bench_city_index.py [path/to/cities.json] [--iterations N]
+# Without a path it uses ./cities.json, or generates a synthetic file if that is missing.
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cities import CityIndex, build_binary
+
+def legacy_validate(path, from_city, to_city):
+    # The original validate_cities() path: parse the whole file and scan a list
+    from_city, to_city = from_city.lower(), to_city.lower()
+    with open(path, 'r') as file:
+        data = json.load(file)
+        city_names = []
+        for city in data:
+            city_names.append(city.get('name').lower())
+    return from_city in city_names and to_city in city_names
+
+def synthetic_cities(count):
+    # Over a quarter of the names start with "Sa" (like San / Santa / Saint), the densest prefix for fuzzy search
+    rng = random.Random(42)
+    return [{"id": i, "name": ("Sa" if rng.random() < 0.27 else "") + "".join(rng.choices(string.ascii_letters, k=rng.randint(4, 14))),
+             "state_code": "XX", "country_code": "XX", "latitude": "0", "longitude": "0"}
+            for i in range(count)]
+
+def bench_complete(index, queries, iterations):
+    # Worst of the per-query averages, in ms
+    results = {}
+    for label, query in queries.items():
+        index.complete(query)
+        results[label] = timeit.timeit(lambda: index.complete(query), number=iterations) / iterations * 1e3
+    return results
+
+def autocomplete_queries(sample):
+    name = CityIndex.normalize(sample[len(sample) // 2]['name'])
+    return {
+        "prefix hit": name[:4],
+        # No name starts with it, so the whole answer comes from fuzzy matching under "sa"
+        "fuzzy, no prefix hit": "saxqzv",
+        "fuzzy, typo": name[:3] + name[4:] if len(name) > 5 else name + "x",
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="CityIndex vs. legacy validate_cities benchmark")
+    parser.add_argument("path", nargs="?", default="cities.json")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--synthetic-size", type=int, default=150000)
+    args = parser.parse_args()
+
+    path = args.path
+    if not os.path.exists(path):
+        print(f"{path} not found, generating {args.synthetic_size} synthetic cities")
+        tmp = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        json.dump(synthetic_cities(args.synthetic_size), tmp)
+        tmp.close()
+        path = tmp.name
+
+    with open(path, 'r') as file:
+        sample = json.load(file)
+    from_city, to_city = sample[0]['name'], sample[-1]['name']
+
+    index = CityIndex(path)
+    # First lookup pays the one-time load
+    cold = timeit.timeit(lambda: from_city in index, number=1)
+    legacy = timeit.timeit(lambda: legacy_validate(path, from_city, to_city), number=args.iterations) / args.iterations
+    warm_iterations = args.iterations * 10000
+    warm = timeit.timeit(lambda: from_city in index and to_city in index, number=warm_iterations) / warm_iterations
+
+    print(f"cities: {len(sample)}")
+    print(f"legacy validate_cities: {legacy * 1e3:10.3f} ms/call")
+    print(f"CityIndex cold load:    {cold * 1e3:10.3f} ms (once per process / file change)")
+    print(f"CityIndex lookup:       {warm * 1e6:10.3f} us/call")
+    print(f"speedup:                {legacy / warm:10.0f}x")
+
+    # Same lookups against the compiled, memory-mapped file
+    binary_path = tempfile.NamedTemporaryFile(suffix='.bin', delete=False).name
+    build_binary(path, binary_path)
+    mapped = CityIndex(path, compiled_path=binary_path)
+    mapped_cold = timeit.timeit(lambda: from_city in mapped, number=1)
+    mapped_warm = timeit.timeit(lambda: from_city in mapped and to_city in mapped, number=warm_iterations) / warm_iterations
+    print(f"mapped cold load:       {mapped_cold * 1e3:10.3f} ms")
+    print(f"mapped lookup:          {mapped_warm * 1e6:10.3f} us/call")
+    print(f"binary file size:       {os.path.getsize(binary_path) / 1e6:10.2f} MB (json: {os.path.getsize(path) / 1e6:.2f} MB)")
+
+    queries = autocomplete_queries(sample)
+    complete_iterations = args.iterations * 50
+    for label, timed in (("json", index), ("mapped", mapped)):
+        for query_label, ms in bench_complete(timed, queries, complete_iterations).items():
+            print(f"{label} complete ({query_label}):".ljust(40) + f"{ms:8.3f} ms/call")
+    os.unlink(binary_path)
+
+    if path != args.path:
+        os.unlink(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Benchmark: itinerary email rendering, the old += f-string builder vs. the precompiled Jinja templates
+#
+# Times each renderer and measures its peak allocation (tracemalloc) for trips of 10 to 1000 events.
+# Usage: python benchmarks/bench_email_render.py [--sizes 10 100 500 1000] [--repeat 20]
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+def legacy_email_content(trip, result):
+    # The original get_email_content(): copies every event, then grows the string one event at a time
+    email_content = f"""
+Hi,
+
+Here is your travel itinerary for your upcoming trip from {trip.start_location} to {trip.travel_location}.
+
+Trip Details:
+- Arrival Date: {trip.arrival_date}
+- Departure Date: {trip.departure_date}
+- Travel Preferences: {trip.travel_preferences}
+
+Itinerary:
+    """
+    event_details = []
+    for event in result["itinerary"]:
+        event_details.append({
+            "name": event["event_name"],
+            "time": event["event_time"],
+            "price": event["event_price"],
+            "address": event["event_address"],
+            "description": event["event_description"]
+        })
+    for i, event in enumerate(event_details, start=1):
+        email_content += f"""
+            Event {i}:
+            - Name: {event['name']}
+            - Time: {event['time']}
+            - Price: {event['price']}
+            - Address: {event['address']}
+            - Description: {event['description']}
+            """
+    email_content += "\n\nWishing you all the best with your upcoming trip. Safe travels!\n"
+    return email_content
+
+def make_result(count):
+    # Raw tool output, as the old builder received it
+    return {"itinerary": [{
+        "event_name": f"\U0001F37D Dinner stop number {i}",
+        "event_time": f"2030-06-{1 + i % 28:02d}T{8 + i % 12:02d}:00:00",
+        "event_price": f"${10 + i % 90}",
+        "event_address": f"{i} Benchmark Ave, Chicago, IL",
+        "event_description": "A longer description of the place, what to order and why it is worth the detour. " * 2,
+    } for i in range(count)]}
+
+def peak_bytes(render):
+    tracemalloc.start()
+    render()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def as_events(result):
+    # The templates get validated ItineraryEvents
+    return dict(result, itinerary=[main.ItineraryEvent.from_dict(event) for event in result["itinerary"]])
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Email rendering benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000], help="events per trip")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    trip = main.Trip("bench@example.com", "Boston", "Chicago", 2, 0, "Flying", None, "Economy",
+                     date(2030, 6, 1), date(2030, 6, 28), "food and museums")
+    renderers = {
+        "legacy +=": lambda result: legacy_email_content(trip, result),
+        "jinja text": lambda result: main.get_email_content(trip, result),
+        "jinja html": lambda result: main.get_email_content(trip, result, html=True),
+    }
+    # Compile the templates before timing
+    for name, render in renderers.items():
+        render(make_result(1) if name.startswith("legacy") else as_events(make_result(1)))
+
+    print(f"{'events':>7}  {'renderer':<12}{'ms/render':>11}{'peak KiB':>11}{'output KiB':>12}")
+    for size in args.sizes:
+        raw = make_result(size)
+        events = as_events(raw)
+        for name, render in renderers.items():
+            result = raw if name.startswith("legacy") else events
+            seconds = min(timeit.repeat(lambda: render(result), number=1, repeat=args.repeat))
+            peak = peak_bytes(lambda: render(result))
+            size_kib = len(render(result).encode()) / 1024
+            print(f"{size:>7}  {name:<12}{seconds * 1e3:>11.3f}{peak / 1024:>11.1f}{size_kib:>12.1f}")
+
+    # Optional fields may be missing: the old builder raised, validated events fill them in
+    sparse = {"itinerary": [{"event_name": "No price", "event_time": "2030-06-01T09:00:00", "event_address": "1 Main St"}]}
+    try:
+        legacy_email_content(trip, sparse)
+        legacy = "ok"
+    except KeyError as e:
+        legacy = f"KeyError {e}"
+    main.get_email_content(trip, as_events(sparse))
+    print(f"event without optional fields: legacy -> {legacy}, jinja -> ok")
+
+if __name__ == "__main__":
+    main_benchmark()
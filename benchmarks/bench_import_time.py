@@ -0,0 +1,62 @@
+# Import-time budget: how long `import main` takes in a fresh interpreter (python -X importtime)
+#
+# Fails (exit code 1) when the import is over budget or when it pulls in a module that should only
+# load on first use (the Anthropic / Arcade SDKs, httpx, email_validator, dotenv).
+# Runs several times and keeps the fastest, since the first run also warms the OS file cache.
+# Usage: python benchmarks/bench_import_time.py [--budget-ms 400] [--runs 5] [--top 15]
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Must not be imported by `import main` alone
+DEFERRED_MODULES = ("anthropic", "arcadepy", "openai", "httpx", "email_validator", "dotenv")
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+def measure():
+    # Returns ({module: (self us, cumulative us, depth)}, eagerly loaded deferred modules)
+    check = f"import json, sys, main; print(json.dumps([m for m in {DEFERRED_MODULES!r} if m in sys.modules]))"
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", check], cwd=ROOT, capture_output=True, text=True)
+    if completed.returncode != 0:
+        sys.exit(f"`import main` failed:\n{completed.stderr[-2000:]}")
+    timings = {}
+    for line in completed.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            timings[module] = (int(self_us), int(cumulative_us), (len(indent) - 1) // 2)
+    return timings, json.loads(completed.stdout.strip().splitlines()[-1])
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Import-time budget for main.py")
+    parser.add_argument("--budget-ms", type=float, default=400, help="fail when `import main` takes longer than this")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest top-level imports to list")
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.runs)]
+    timings, eager = min(runs, key=lambda run: run[0]["main"][1])
+    total_ms = timings["main"][1] / 1000
+    # Direct imports of main (and main's own body) are what a change to main.py can move
+    direct = sorted(((cumulative, module) for module, (_, cumulative, depth) in timings.items() if depth == 1), reverse=True)
+    print(f"import main: {total_ms:.1f} ms (best of {args.runs}), budget {args.budget_ms:.0f} ms")
+    print(f"main.py itself: {timings['main'][0] / 1000:.1f} ms")
+    for cumulative, module in direct[:args.top]:
+        print(f"  {module:<30}{cumulative / 1000:8.1f} ms")
+
+    failed = False
+    if eager:
+        print(f"FAIL: imported eagerly: {', '.join(eager)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"FAIL: {total_ms:.1f} ms is over the {args.budget_ms:.0f} ms budget")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main_benchmark()
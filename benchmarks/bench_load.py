@@ -0,0 +1,320 @@
+# End-to-end load benchmark: drives the Flask app over HTTP against the fake Anthropic and Arcade backends
+#
+# Starts both fakes in this process and the app in a child process (pointed at the fakes through
+# ANTHROPIC_BASE_URL / ARCADE_BASE_URL), then plans `--trips` trips with `--concurrency` simulated users.
+# Each user walks the real flow: /planner -> /loading -> /backend_processing -> polls /api/job_status -> /submitted.
+# Reports throughput, p50/p95/p99 per stage, the app's peak RSS and thread count and its /metrics stage timings,
+# and saves everything as JSON (benchmarks/results/ by default) so runs can be compared.
+# --asgi serves the app through uvicorn (asgi.py) instead of a threaded WSGI server.
+# Both cities must be in cities.json.
+# Any other setting (PLANNER_WORKERS, DELIVERY_MODE, ...) is passed to the app from this environment.
+#
+# Usage: python benchmarks/bench_load.py [--trips 40] [--concurrency 8] [--anthropic-latency 2] [--arcade-error-rate 0.05] [--asgi]
+import argparse
+import json
+import math
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import httpx
+
+from fake_backends import FakeAnthropic, FakeArcade
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ("submit", "loading", "backend_processing", "first_event", "plan", "delivered", "results", "total")
+
+def serve_app(port, asgi=False):
+    # Child process: the app behind a threaded WSGI server (no debugger or reloader), or uvicorn
+    sys.path.insert(0, ROOT)
+    if asgi:
+        import uvicorn
+        return uvicorn.run("asgi:app", host="127.0.0.1", port=port, log_level="warning", access_log=False)
+    import logging
+    from werkzeug.serving import make_server
+    # One access log line per poll would drown out the app's own warnings
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    import main
+    make_server("127.0.0.1", port, main.create_app(), threaded=True).serve_forever()
+
+def start_app(port, anthropic_url, arcade_url, workdir, asgi=False):
+    env = dict(
+        os.environ,
+        ANTHROPIC_BASE_URL=anthropic_url,
+        ARCADE_BASE_URL=arcade_url,
+        ANTHROPIC_API_KEY="fake-anthropic-key",
+        ARCADE_API_KEY="fake-arcade-key",
+    )
+    # Keep the benchmark's queued deliveries and jobs out of the real database files
+    env.setdefault("OUTBOX_PATH", os.path.join(workdir, "outbox.db"))
+    env.setdefault("JOB_STORE_PATH", os.path.join(workdir, "jobs.db"))
+    env.setdefault("LOG_LEVEL", "WARNING")
+    # Every simulated user comes from this one IP
+    env.setdefault("RATE_LIMIT_IP_PER_HOUR", "0")
+    command = [sys.executable, os.path.abspath(__file__), "--serve", str(port)] + (["--asgi"] if asgi else [])
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited during startup (code {process.returncode})")
+        try:
+            httpx.get(url + "/metrics", timeout=1)
+            return process, url
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("The app did not start within 60 seconds")
+
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def trip_form(args, number):
+    arrival = date.today() + timedelta(days=30)
+    # One address per simulated user, so repeat-submission matching and per-user rate limits leave them alone
+    local, domain = args.email.split("@")
+    return {
+        "user_email": f"{local}+{number}@{domain}",
+        "start_location": args.start,
+        "travel_location": args.destination,
+        "arrival_date": arrival.isoformat(),
+        "departure_date": (arrival + timedelta(days=args.days)).isoformat(),
+        "passenger_adult_count": "2",
+        "passenger_child_count": "0",
+        "travel_style": "Flying",
+        "travel_class": "Economy",
+        "car_type": "",
+        # Unique trips unless --same-trip, so the itinerary cache does not answer them
+        "travel_preferences": "museums" if args.same_trip else f"museums (load test trip {number})",
+    }
+
+def run_trip(args, url, number):
+    """
+    One simulated user. Returns {"ok": bool, "error": str or None, stage: seconds, ...}.
+    """
+    timings = {"ok": False, "error": None}
+    started = time.perf_counter()
+
+    def mark(stage, since=started):
+        timings[stage] = time.perf_counter() - since
+
+    with httpx.Client(base_url=url, timeout=args.request_timeout) as client:
+        try:
+            step = time.perf_counter()
+            response = client.post("/planner", data=trip_form(args, number))
+            mark("submit", step)
+            location = response.headers.get("location", "")
+            match = re.search(r"/loading/([0-9a-f]+)", location)
+            if response.status_code != 302 or not match:
+                timings["error"] = {503: "rejected", 429: "rate_limited"}.get(response.status_code, f"planner HTTP {response.status_code}")
+                return timings
+            job_id = match.group(1)
+
+            step = time.perf_counter()
+            client.get(location).raise_for_status()
+            mark("loading", step)
+            step = time.perf_counter()
+            client.get("/backend_processing")
+            mark("backend_processing", step)
+
+            # Poll like loading.html does
+            while True:
+                status = client.get(f"/api/job_status/{job_id}").json()
+                if "first_event" not in timings and status.get("planned_events"):
+                    mark("first_event")
+                if status["status"] == "completed":
+                    mark("plan")
+                    break
+                if status["status"] == "failed":
+                    timings["error"] = status.get("error") or "job failed"
+                    return timings
+                if time.perf_counter() - started > args.trip_timeout:
+                    timings["error"] = "timed out"
+                    return timings
+                time.sleep(args.poll_interval)
+
+            # With the outbox, email and calendar delivery finishes after the plan
+            while args.wait_delivery:
+                delivery = status.get("delivery")
+                if not delivery or not (delivery.get("pending") or delivery.get("in_flight")):
+                    mark("delivered")
+                    break
+                if time.perf_counter() - started > args.trip_timeout:
+                    timings["error"] = "delivery timed out"
+                    return timings
+                time.sleep(args.poll_interval)
+                status = client.get(f"/api/job_status/{job_id}").json()
+
+            step = time.perf_counter()
+            client.get("/submitted", follow_redirects=True).raise_for_status()
+            mark("results", step)
+            mark("total")
+            timings["ok"] = True
+        except Exception as e:
+            timings["error"] = f"{type(e).__name__}: {e}"
+    return timings
+
+def percentile(values, fraction):
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values),
+    }
+
+def server_stage_timings(metrics_text):
+    # Mean seconds per stage from the app's own stage_duration_seconds histogram
+    sums, counts = {}, {}
+    for line in metrics_text.splitlines():
+        match = re.match(r'travel_agent_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)', line)
+        if match:
+            (sums if match.group(1) == "sum" else counts)[match.group(2)] = float(match.group(3))
+    return {stage: {"count": int(counts[stage]), "mean": sums[stage] / counts[stage]} for stage in sums if counts.get(stage)}
+
+def peak_child_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class ThreadSampler:
+    """
+    Polls the app process's thread count (Linux /proc) while the benchmark runs and keeps the peak.
+    """
+    def __init__(self, pid, interval=0.1):
+        self.path = f"/proc/{pid}/status"
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with open(self.path) as status:
+                    threads = next(int(line.split()[1]) for line in status if line.startswith("Threads:"))
+            except (OSError, StopIteration):
+                return
+            self.peak = max(self.peak or 0, threads)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark against fake backends")
+    parser.add_argument("--trips", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8, help="simulated users planning trips at the same time")
+    parser.add_argument("--anthropic-latency", type=float, default=2.0, help="seconds per Claude response")
+    parser.add_argument("--arcade-latency", type=float, default=0.1, help="seconds per Arcade call")
+    parser.add_argument("--anthropic-error-rate", type=float, default=0.0, help="share of Claude calls answered with 529 overloaded")
+    parser.add_argument("--arcade-error-rate", type=float, default=0.0, help="share of Arcade tool executions answered with 500")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency spread as a fraction of the latency")
+    parser.add_argument("--events", type=int, default=12, help="events in each Claude response")
+    parser.add_argument("--days", type=int, default=3, help="length of each trip")
+    parser.add_argument("--start", default="Boston")
+    parser.add_argument("--destination", default="Chicago")
+    parser.add_argument("--email", default="load-test@gmail.com", help="trip N is planned for <name>+N@<domain>")
+    parser.add_argument("--same-trip", action="store_true", help="plan the same trip every time (measures the itinerary cache)")
+    parser.add_argument("--no-wait-delivery", dest="wait_delivery", action="store_false", help="do not wait for queued email / calendar delivery")
+    parser.add_argument("--poll-interval", type=float, default=0.25)
+    parser.add_argument("--request-timeout", type=float, default=30)
+    parser.add_argument("--trip-timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="results file (default: benchmarks/results/load-<time>.json)")
+    parser.add_argument("--asgi", action="store_true", help="serve the app with uvicorn (asgi.py) instead of a threaded WSGI server")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve_app(args.serve, asgi=args.asgi)
+
+    fake_anthropic = FakeAnthropic(events=args.events, latency=args.anthropic_latency, jitter=args.jitter,
+                                   error_rate=args.anthropic_error_rate, seed=args.seed).start()
+    fake_arcade = FakeArcade(latency=args.arcade_latency, jitter=args.jitter, error_rate=args.arcade_error_rate, seed=args.seed + 1).start()
+    with tempfile.TemporaryDirectory(prefix="bench-load-") as workdir:
+        app, url = start_app(free_port(), fake_anthropic.url, fake_arcade.url, workdir, asgi=args.asgi)
+        try:
+            started = time.perf_counter()
+            with ThreadSampler(app.pid) as threads, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                trips = list(pool.map(lambda number: run_trip(args, url, number), range(args.trips)))
+            elapsed = time.perf_counter() - started
+            metrics_text = httpx.get(url + "/metrics", timeout=10).text
+        finally:
+            app.terminate()
+            app.wait(timeout=30)
+        fake_anthropic.stop()
+        fake_arcade.stop()
+
+    completed = [timings for timings in trips if timings["ok"]]
+    errors = {}
+    for timings in trips:
+        if not timings["ok"]:
+            errors[timings["error"]] = errors.get(timings["error"], 0) + 1
+    results = {
+        "run": {
+            "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {key: value for key, value in vars(args).items() if key not in ("serve", "output")},
+            "app_env": {key: value for key, value in os.environ.items()
+                        if key.startswith(("PLANNER_", "CLAUDE_", "DELIVERY_", "OUTBOX_", "CALENDAR_", "STREAM_", "JOB_", "ITINERARY_", "HTTP_", "TOOL_"))},
+        },
+        "elapsed_seconds": elapsed,
+        "trips": args.trips,
+        "completed": len(completed),
+        "errors": errors,
+        "throughput_trips_per_second": len(completed) / elapsed if elapsed else 0.0,
+        "stages": {stage: summarize([timings[stage] for timings in completed if stage in timings]) for stage in STAGES},
+        "server_stages": server_stage_timings(metrics_text),
+        "app_peak_rss_mb": peak_child_rss_mb(),
+        "app_peak_threads": threads.peak,
+        "backends": {
+            "anthropic": {"requests": fake_anthropic.requests, "injected_errors": fake_anthropic.errors},
+            "arcade": {"requests": fake_arcade.requests, "injected_errors": fake_arcade.errors},
+        },
+    }
+
+    print(f"trips: {args.trips}, concurrency: {args.concurrency}, completed: {len(completed)}, elapsed: {elapsed:.2f} s")
+    print(f"throughput: {results['throughput_trips_per_second']:.2f} trips/s, app peak RSS: {results['app_peak_rss_mb']:.1f} MB, "
+          f"app peak threads: {results['app_peak_threads'] if results['app_peak_threads'] is not None else 'n/a'}")
+    if errors:
+        print(f"errors: {errors}")
+    print(f"{'stage':<20}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}{'max (s)':>10}")
+    for stage, summary in results["stages"].items():
+        if summary:
+            print(f"{stage:<20}{summary['p50']:>10.3f}{summary['p95']:>10.3f}{summary['p99']:>10.3f}{summary['max']:>10.3f}")
+    for stage, summary in sorted(results["server_stages"].items()):
+        print(f"  server {stage:<22} mean {summary['mean']:.4f} s over {summary['count']}")
+
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", time.strftime("load-%Y%m%d-%H%M%S.json"))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Saved results to {output}")
+
+if __name__ == "__main__":
+    main_benchmark()
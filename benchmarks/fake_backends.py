@@ -0,0 +1,194 @@
+# Local stand-ins for the Anthropic Messages API and the Arcade tools API, for benchmarks
+#
+# Both speak enough of the real HTTP protocols for the official SDKs, so the app can be pointed at them with
+# ANTHROPIC_BASE_URL / ARCADE_BASE_URL and run unmodified. Latency and error rates are configurable.
+# Usage (standalone): python benchmarks/fake_backends.py [--anthropic-port 8701] [--arcade-port 8702] [--anthropic-latency 2]
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class _Server(ThreadingHTTPServer):
+    # The default listen backlog (5) drops connections when hundreds of trips open them at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+class FakeBackend:
+    """
+    Threaded HTTP server with latency and error injection. Counts requests and injected errors.
+    Latency is `latency` seconds, spread by +/- `jitter` (a fraction of it).
+    """
+    def __init__(self, handler, latency=0.0, jitter=0.2, error_rate=0.0, port=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self.server = _Server(("127.0.0.1", port), handler)
+        self.server.backend = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def next_delay(self):
+        with self._lock:
+            spread = self._random.uniform(-self.jitter, self.jitter)
+        return max(0.0, self.latency * (1 + spread))
+
+    def next_request(self):
+        # Returns (request number, whether to fail it)
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return next(self._ids), fail
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class _AnthropicHandler(_JSONHandler):
+    def do_POST(self):
+        backend = self.server.backend
+        if not self.path.startswith("/v1/messages"):
+            return self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+        body = self.read_json()
+        number, fail = backend.next_request()
+        delay = backend.next_delay()
+        if fail:
+            # Overloaded, like a real 529 (the app retries it with backoff)
+            time.sleep(delay / 10)
+            return self.send_json(529, {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}}, {"retry-after": "0"})
+        tool_input = {"events": backend.make_events(number)}
+        usage = {"input_tokens": 1200, "output_tokens": 150 * backend.events}
+        message = {"id": f"msg_{number}", "type": "message", "role": "assistant", "model": body.get("model", "fake"),
+                   "stop_reason": "tool_use", "stop_sequence": None, "usage": usage}
+        tool_use = {"type": "tool_use", "id": f"toolu_{number}", "name": "travel_events"}
+        if not body.get("stream"):
+            time.sleep(delay)
+            return self.send_json(200, dict(message, content=[dict(tool_use, input=tool_input)]))
+
+        # Streamed: first token after a fifth of the latency, the rest spread over the remaining time
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send(event_type, data):
+            self.wfile.write(f"event: {event_type}\ndata: {json.dumps(dict(data, type=event_type))}\n\n".encode())
+            self.wfile.flush()
+
+        time.sleep(delay / 5)
+        send("message_start", {"message": dict(message, content=[], stop_reason=None, usage=dict(usage, output_tokens=1))})
+        send("content_block_start", {"index": 0, "content_block": dict(tool_use, input={})})
+        raw = json.dumps(tool_input)
+        chunks = [raw[i:i + 64] for i in range(0, len(raw), 64)]
+        for chunk in chunks:
+            send("content_block_delta", {"index": 0, "delta": {"type": "input_json_delta", "partial_json": chunk}})
+            time.sleep(delay * 0.8 / len(chunks))
+        send("content_block_stop", {"index": 0})
+        send("message_delta", {"delta": {"stop_reason": "tool_use", "stop_sequence": None}, "usage": {"output_tokens": usage["output_tokens"]}})
+        send("message_stop", {})
+
+class FakeAnthropic(FakeBackend):
+    """
+    Answers POST /v1/messages (streamed or not) with a travel_events tool call of `events` events.
+    """
+    def __init__(self, events=12, **kwargs):
+        super().__init__(_AnthropicHandler, **kwargs)
+        self.events = events
+
+    def make_events(self, number):
+        return [{
+            "event_name": f"\U0001F5FA Stop {i + 1} of response {number}",
+            "event_time": f"2030-06-{1 + i // 6:02d}T{8 + 2 * (i % 6):02d}:00:00",
+            "event_price": f"${10 + i}",
+            "event_address": f"{100 + i} Benchmark Ave",
+            "event_description": "Generated by the fake Anthropic backend",
+        } for i in range(self.events)]
+
+class _ArcadeHandler(_JSONHandler):
+    def do_POST(self):
+        backend = self.server.backend
+        body = self.read_json()
+        number, fail = backend.next_request()
+        time.sleep(backend.next_delay())
+        if self.path.startswith("/v1/tools/authorize"):
+            return self.send_json(200, {"id": f"auth_{number}", "status": "completed", "user_id": body.get("user_id")})
+        if self.path.startswith("/v1/tools/execute"):
+            if fail:
+                return self.send_json(500, {"name": "internal_error", "message": "injected Arcade failure"})
+            return self.send_json(200, {"id": f"exec_{number}", "execution_id": f"exec_{number}", "success": True,
+                                        "output": {"value": "ok"}})
+        self.send_json(404, {"message": self.path})
+
+    def do_GET(self):
+        backend = self.server.backend
+        number, _ = backend.next_request()
+        time.sleep(backend.next_delay())
+        if self.path.startswith("/v1/auth/status"):
+            return self.send_json(200, {"id": f"auth_{number}", "status": "completed"})
+        self.send_json(404, {"message": self.path})
+
+class FakeArcade(FakeBackend):
+    """
+    Answers tool authorization (always already granted), auth status and tool execution.
+    Only executions fail when errors are injected, with an HTTP 500.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(_ArcadeHandler, **kwargs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the fake Anthropic and Arcade backends")
+    parser.add_argument("--anthropic-port", type=int, default=8701)
+    parser.add_argument("--arcade-port", type=int, default=8702)
+    parser.add_argument("--anthropic-latency", type=float, default=2.0, help="seconds per Claude response")
+    parser.add_argument("--arcade-latency", type=float, default=0.1, help="seconds per Arcade call")
+    parser.add_argument("--anthropic-error-rate", type=float, default=0.0)
+    parser.add_argument("--arcade-error-rate", type=float, default=0.0)
+    parser.add_argument("--events", type=int, default=12, help="events in each Claude response")
+    args = parser.parse_args()
+    anthropic_backend = FakeAnthropic(events=args.events, latency=args.anthropic_latency, error_rate=args.anthropic_error_rate, port=args.anthropic_port).start()
+    arcade_backend = FakeArcade(latency=args.arcade_latency, error_rate=args.arcade_error_rate, port=args.arcade_port).start()
+    print(f"ANTHROPIC_BASE_URL={anthropic_backend.url}")
+    print(f"ARCADE_BASE_URL={arcade_backend.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,244 @@
+# City name index used to validate trip locations and autocomplete them
+#
+# Build the compact binary dataset with:  python cities.py cities.json cities.bin
+import argparse
+import bisect
+import difflib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import unicodedata
+
+# Binary layout: header, (count + 1) little-endian uint32 offsets, then "key\0display" UTF-8 records sorted by key
+BINARY_MAGIC = b"CITYIDX1"
+BINARY_HEADER = struct.Struct("<8sII")
+BINARY_OFFSET = struct.Struct("<I")
+
+log = logging.getLogger("travel_agent")
+
+class MappedCities:
+    """
+    Zero-copy view over a memory-mapped binary city file. Behaves like two read-only sequences
+    (`keys` and `display`) so bisect can binary-search it without loading anything up front.
+    Forked workers share the mapped pages through the OS page cache.
+    There is no close(): a request may still be reading an old mapping while the file is reloaded, so each one
+    is unmapped once nothing refers to it any more.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, _ = BINARY_HEADER.unpack_from(self._map, 0)
+        if magic != BINARY_MAGIC:
+            raise ValueError(f"{path} is not a compiled city file")
+        self._data_start = BINARY_HEADER.size + BINARY_OFFSET.size * (self.count + 1)
+        self._view = memoryview(self._map)[BINARY_HEADER.size:self._data_start]
+        # Read offsets straight out of the mapping when the host is little-endian (almost always)
+        if sys.byteorder == "little":
+            self._offsets = self._view.cast("I")
+        else:
+            self._offsets = [value for (value,) in BINARY_OFFSET.iter_unpack(self._view)]
+
+    # Made on access rather than stored, so the fields and the mapping never form a reference cycle
+    # (which would keep an old mapping alive until the garbage collector happens to run)
+    @property
+    def keys(self):
+        return _MappedField(self, 0)
+
+    @property
+    def display(self):
+        return _MappedField(self, 1)
+
+    def record(self, i, field):
+        start = self._data_start + self._offsets[i]
+        end = self._data_start + self._offsets[i + 1]
+        separator = self._map.find(b"\0", start, end)
+        if field == 0:
+            return self._map[start:separator].decode("utf-8")
+        return self._map[separator + 1:end].decode("utf-8")
+
+    def records(self, start, stop, field):
+        # Records start..stop-1 read in one slice of the mapping (faster than one record() call each)
+        offsets, first = self._offsets, self._offsets[start]
+        blob = self._map[self._data_start + first:self._data_start + offsets[stop]]
+        values = []
+        for i in range(start, stop):
+            begin, end = offsets[i] - first, offsets[i + 1] - first
+            separator = blob.index(b"\0", begin, end)
+            values.append((blob[begin:separator] if field == 0 else blob[separator + 1:end]).decode("utf-8"))
+        return values
+
+class _MappedField:
+    def __init__(self, cities, field):
+        self._cities = cities
+        self._field = field
+
+    def __len__(self):
+        return self._cities.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return self._cities.records(start, max(start, stop), self._field)
+            return [self[j] for j in range(start, stop, step)]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._cities.record(i, self._field)
+
+def build_binary(json_path, binary_path):
+    """
+    Converts cities.json into the compact binary format read by MappedCities.
+    """
+    with open(json_path, 'r') as file:
+        data = json.load(file)
+    display = {}
+    for city in data:
+        if city.get('name'):
+            display.setdefault(CityIndex.normalize(city['name']), city['name'])
+    blob = bytearray()
+    offsets = [0]
+    for key in sorted(display):
+        blob += key.encode("utf-8") + b"\0" + display[key].encode("utf-8")
+        offsets.append(len(blob))
+    # Write to a temporary file first so running servers never map a half-written file
+    tmp_path = binary_path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(BINARY_HEADER.pack(BINARY_MAGIC, len(display), 0))
+        file.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        file.write(blob)
+    os.replace(tmp_path, binary_path)
+    return len(display)
+
+class CityIndex:
+    """
+    In-memory index of every known city name, shared across requests.
+    Loaded lazily on first use and rebuilt whenever the backing file's mtime changes.
+    Holds a hash set for exact lookups and a sorted key array for prefix (autocomplete) searches.
+    When the compiled binary file exists (and is not older than the json file) it is memory-mapped instead,
+    and lookups binary-search it in place.
+    """
+    # Fuzzy matching only looks at names sharing this many leading characters with the query
+    FUZZY_PREFIX = 3
+    # ... and at most this many of them, the ones sorting closest to the query, so a lookup stays under a millisecond
+    # (see benchmarks/bench_city_index.py; the mapped index has to decode every candidate it scores)
+    FUZZY_CANDIDATES = 128
+
+    def __init__(self, path, compiled_path=None):
+        self.path = path
+        self.compiled_path = compiled_path
+        self._names = frozenset()
+        self._keys = []
+        self._display = []
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(name):
+        # Standardized to lowercase format without accents and with single spaces ("São  Paulo" -> "sao paulo")
+        decomposed = unicodedata.normalize("NFKD", name.casefold())
+        return " ".join("".join(char for char in decomposed if not unicodedata.combining(char)).split())
+
+    def _load(self, path, mtime):
+        if path == self.compiled_path:
+            # No parsing: the mapped file already holds sorted, normalized names
+            # (the previous mapping is released once no request is still reading it)
+            cities = MappedCities(path)
+            self._keys, self._display, self._names = cities.keys, cities.display, None
+            self._mtime = (path, mtime)
+            log.info(f"City index mapped with {cities.count} names")
+        else:
+            if self.compiled_path and os.path.exists(self.compiled_path):
+                log.warning(f"{self.path} is newer than {self.compiled_path}; using it until the binary index is rebuilt")
+            self._load_json(mtime)
+
+    def _load_json(self, mtime):
+        # Parse the json file filled with all city names (only done when the file changes)
+        with open(self.path, 'r') as file:
+            data = json.load(file)
+        display = {}
+        for city in data:
+            if city.get('name'):
+                display.setdefault(self.normalize(city['name']), city['name'])
+        self._keys = sorted(display)
+        self._display = [display[key] for key in self._keys]
+        self._names = frozenset(self._keys)
+        self._mtime = (self.path, mtime)
+        log.info(f"City index loaded with {len(self._names)} names")
+
+    def _refresh(self):
+        # Prefer the compiled binary file when it has been built, unless cities.json was changed after it
+        path = self.path
+        if self.compiled_path and os.path.exists(self.compiled_path):
+            if not os.path.exists(self.path) or os.stat(self.compiled_path).st_mtime_ns >= os.stat(self.path).st_mtime_ns:
+                path = self.compiled_path
+        mtime = (path, os.stat(path).st_mtime_ns)
+        if mtime != self._mtime:
+            with self._lock:
+                # Another thread may have reloaded while we waited
+                if mtime != self._mtime:
+                    self._load(*mtime)
+
+    def __contains__(self, name):
+        self._refresh()
+        key = self.normalize(name)
+        if self._names is not None:
+            return key in self._names
+        keys = self._keys
+        i = bisect.bisect_left(keys, key)
+        return i < len(keys) and keys[i] == key
+
+    def complete(self, query, limit=10):
+        """
+        Returns up to `limit` city names starting with `query` (ignoring case and accents),
+        topped up with close spellings when there are not enough prefix matches.
+        """
+        self._refresh()
+        keys, display = self._keys, self._display
+        query = self.normalize(query)
+        if not query:
+            return []
+        start = bisect.bisect_left(keys, query)
+        end = bisect.bisect_left(keys, query + "\uffff", start)
+        results = display[start:min(end, start + limit)]
+        if len(results) < limit and len(query) >= 3:
+            results += self._fuzzy(keys, display, query, limit - len(results), exclude=range(start, end))
+        return results
+
+    def _fuzzy(self, keys, display, query, limit, exclude):
+        # Bounded fuzzy search: same leading letters, similar length, closest spellings first
+        # (over the same keys / display as the caller, even if the index is reloaded meanwhile)
+        prefix = query[:self.FUZZY_PREFIX]
+        first = bisect.bisect_left(keys, prefix)
+        last = bisect.bisect_left(keys, prefix + "\uffff", first)
+        # In a crowded prefix, only look at the names around where the query itself would sort
+        middle = bisect.bisect_left(keys, query, first, last)
+        start = max(first, min(middle - self.FUZZY_CANDIDATES // 2, last - self.FUZZY_CANDIDATES))
+        end = min(last, start + self.FUZZY_CANDIDATES)
+        matcher = difflib.SequenceMatcher(b=query, autojunk=False)
+        scored = []
+        for i, key in enumerate(keys[start:end], start):
+            if i in exclude:
+                continue
+            if abs(len(key) - len(query)) > 2:
+                continue
+            matcher.set_seq1(key)
+            if matcher.real_quick_ratio() >= 0.8 and matcher.quick_ratio() >= 0.8:
+                ratio = matcher.ratio()
+                if ratio >= 0.8:
+                    scored.append((-ratio, i))
+        scored.sort()
+        return [display[i] for _, i in scored[:limit]]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile cities.json into the memory-mapped city index")
+    parser.add_argument("json_path", nargs="?", default="cities.json")
+    parser.add_argument("binary_path", nargs="?", default="cities.bin")
+    args = parser.parse_args()
+    count = build_binary(args.json_path, args.binary_path)
+    print(f"Wrote {count} cities to {args.binary_path}")
@@ -1,86 +1,1432 @@
 # Import all necessary libraries
-from flask import Flask, render_template, request, redirect, url_for, flash
+# (the Anthropic / Arcade SDKs, httpx, email_validator and dotenv are imported where they are first used,
+#  so importing this module stays fast and never needs API keys)
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, session, send_file
 import os
+import io
 import sys
-from openai import OpenAI
-from datetime import datetime, timedelta 
+from dataclasses import dataclass, field, fields
+from datetime import date, datetime, timedelta, timezone
 import json
-from email_validator import validate_email, EmailNotValidError
-import anthropic
-import traceback
+import asyncio
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import queue
+import random
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from arcadepy import Arcade
-from dotenv import load_dotenv, find_dotenv
-from anthropic._exceptions import OverloadedError
-
-class trip:
-    """ 
-    Represents a travel booking with passenger details and preferences. 
-    Stores all necessary information to curate the travel plan. 
-    """
-    def __init__(self, user_email, start_location, travel_location, passenger_adult_count, passenger_child_count, travel_style, car_type, travel_class, arrival_date, departure_date, travel_preferences):
-        self.user_email = user_email
-        self.start_location = start_location
-        self.travel_location = travel_location
-        self.passenger_adult_count = passenger_adult_count
-        self.passenger_child_count = passenger_child_count
-        self.travel_style = travel_style
-        self.car_type = car_type
-        self.travel_class = travel_class
-        self.arrival_date = arrival_date
-        self.departure_date = departure_date
-        self.travel_preferences = travel_preferences
-
-# Initialize constants
-MY_TRIP = None
-anthropic_client = None
-USER_ID = None
-
-# Load API key from encrypted .env file
-def get_api_keys():
-    global arcade_api_key, openai_api_key, anthropic_api_key
+from cities import CityIndex
+from metrics import Metrics
+
+log = logging.getLogger("travel_agent")
+_logging_ready = False
+
+def setup_logging(level):
+    """
+    Leveled logging for the whole app. Records are queued in memory and written to stdout by a
+    background thread, so request and planner threads never wait on a slow terminal or pipe.
+    Called by create_app(); only the first call does anything.
+    """
+    global _logging_ready
+    if _logging_ready:
+        return log
+    _logging_ready = True
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    log.setLevel(level)
+    log.addHandler(logging.handlers.QueueHandler(records))
+    log.propagate = False
+    listener.start()
+    # Flush whatever is still queued on shutdown
+    atexit.register(listener.stop)
+    if hasattr(os, "register_at_fork"):
+        # The writer thread does not survive a fork; give each worker its own
+        def restart_listener():
+            listener._thread = None
+            listener.start()
+        os.register_at_fork(after_in_child=restart_listener)
+    return log
+
+# Latency histograms and counters for every stage of a trip, served at /metrics
+METRICS = Metrics("travel_agent_")
+METRICS.describe("stage_duration_seconds", "histogram", "Time spent in each stage of planning and delivering a trip")
+METRICS.describe("tool_authorization_seconds", "histogram", "Time spent checking (or waiting on) an Arcade tool authorization")
+METRICS.describe("tool_execution_seconds", "histogram", "Time spent executing an Arcade tool")
+METRICS.describe("errors_total", "counter", "Errors by stage")
+METRICS.describe("retries_total", "counter", "Retried calls by stage")
+METRICS.describe("jobs_total", "counter", "Finished planner jobs by outcome")
+METRICS.describe("trip_submissions_total", "counter", "Planner form submissions by outcome (queued, duplicate, rate_limited, rejected)")
+
+@dataclass(slots=True)
+class Trip:
+    """
+    Represents a travel booking with passenger details and preferences.
+    Stores all necessary information to curate the travel plan.
+    """
+    user_email: str
+    start_location: str
+    travel_location: str
+    passenger_adult_count: int
+    passenger_child_count: int
+    travel_style: str
+    car_type: str | None
+    travel_class: str | None
+    arrival_date: date
+    departure_date: date
+    travel_preferences: str | None
+
+    def to_dict(self):
+        # JSON-friendly copy so the trip can be kept in any job store
+        data = {item.name: getattr(self, item.name) for item in fields(self)}
+        data["arrival_date"] = self.arrival_date.isoformat()
+        data["departure_date"] = self.departure_date.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["arrival_date"] = datetime.strptime(data["arrival_date"], '%Y-%m-%d').date()
+        data["departure_date"] = datetime.strptime(data["departure_date"], '%Y-%m-%d').date()
+        return cls(**data)
+
+    def fingerprint(self):
+        # Hash of the normalized trip, email included (case and spacing in the text fields do not matter)
+        data = {name: " ".join(value.split()).casefold() if isinstance(value, str) else value
+                for name, value in self.to_dict().items()}
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+class InvalidEventError(ValueError):
+    pass
+
+@dataclass(slots=True, frozen=True)
+class ItineraryEvent:
+    """
+    One event of a planned trip, checked against the travel_events tool schema when Claude's output is read.
+    `start` is the event time parsed once (None when Claude did not give an ISO time).
+    """
+    event_name: str
+    event_time: str
+    event_address: str
+    event_price: str = ""
+    event_description: str = ""
+    start: datetime | None = field(default=None, compare=False, repr=False)
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise InvalidEventError(f"expected an object, got {type(data).__name__}")
+        values = {}
+        for name in EVENT_FIELDS:
+            value = data.get(name)
+            # Claude sometimes writes prices or times as numbers; everything in the schema is a string
+            values[name] = "" if value is None else str(value).strip()
+        missing = [name for name in EVENT_REQUIRED_FIELDS if not values[name]]
+        if missing:
+            raise InvalidEventError(f"missing {', '.join(missing)}")
+        return cls(**values, start=parse_event_time(values["event_time"]))
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in EVENT_FIELDS}
+
+    def sort_key(self):
+        # By time, with events whose time could not be read last
+        if self.start is None:
+            return (1, 0)
+        return (0, (self.start if self.start.tzinfo else self.start.replace(tzinfo=timezone.utc)).timestamp())
+
+class Job:
+    """
+    Tracks one trip planning request while it waits for and runs on the planner worker pool.
+    Polled by the loading page through /api/job_status/<job_id>.
+    """
+    def __init__(self, job_id, trip):
+        self.job_id = job_id
+        self.trip = trip
+        self.status = "pending"
+        self.message = "Your trip is waiting in line for our travel planner..."
+        self.error = None
+        self.result = None
+        self.planned_events = []
+        self.created_at = time.time()
+
+    def to_status(self):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "message": self.message,
+            "error": self.error,
+            "planned_events": self.planned_events,
+        }
+
+    def to_dict(self):
+        data = dict(vars(self))
+        data["trip"] = self.trip.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data["job_id"], Trip.from_dict(data["trip"]))
+        for name in ("status", "message", "error", "result", "planned_events", "created_at"):
+            if name in data:
+                setattr(job, name, data[name])
+        if job.result and job.result.get("itinerary"):
+            # Stores that went through JSON hand back plain dicts; the in-memory store keeps the events
+            job.result = dict(job.result, itinerary=[
+                event if isinstance(event, ItineraryEvent) else ItineraryEvent.from_dict(event)
+                for event in job.result["itinerary"]
+            ])
+        return job
+
+def to_json(value):
+    # json.dumps() fallback for the records kept in job stores (trips and itinerary events)
+    return value.to_dict()
+
+class MemoryJobStore:
+    """
+    Keeps jobs (and the trips they carry) in this process, evicting them after a TTL.
+    Repeat submissions of a trip are matched to its job by a dedupe key for `dedupe_ttl` seconds (0 turns this off).
+    Safe across threads, but every server process gets its own copy.
+    """
+    def __init__(self, ttl, dedupe_ttl=0):
+        self.ttl = ttl
+        self.dedupe_ttl = dedupe_ttl
+        self._jobs = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        expired = [job_id for job_id, (expires_at, _) in self._jobs.items() if expires_at <= now]
+        for job_id in expired:
+            del self._jobs[job_id]
+        expired = [key for key, (expires_at, _) in self._keys.items() if expires_at <= now]
+        for key in expired:
+            del self._keys[key]
+
+    def save(self, job):
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            self._jobs[job.job_id] = (now + self.ttl, job.to_dict())
+
+    def claim(self, job, key):
+        """
+        Saves the job under the dedupe key unless a live job (queued, running or completed) already holds it.
+        Returns the ID of the job holding the key.
+        """
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            job_id = self._find(key, now)
+            if job_id is not None:
+                return job_id
+            self._jobs[job.job_id] = (now + self.ttl, job.to_dict())
+            if self.dedupe_ttl > 0:
+                self._keys[key] = (now + self.dedupe_ttl, job.job_id)
+            return job.job_id
+
+    def find(self, key):
+        # ID of the live job holding the dedupe key, or None (failed jobs free their key)
+        with self._lock:
+            return self._find(key, time.time())
+
+    def _find(self, key, now):
+        expires_at, job_id = self._keys.get(key, (0, None))
+        job = self._jobs.get(job_id)
+        if expires_at <= now or job is None or job[0] <= now or job[1]["status"] == "failed":
+            return None
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            if entry is None or entry[0] <= time.time():
+                return None
+            return Job.from_dict(entry[1])
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            if entry is not None:
+                entry[1].update(fields)
+
+class SQLiteFile:
+    """
+    Base for state kept in a local SQLite file that any thread or server process can open.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        # One connection per thread (and per process, since connections must not cross a fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+class SQLiteJobStore(SQLiteFile):
+    """
+    Keeps jobs in a local SQLite file so every thread and gunicorn worker on the host sees the same state.
+    Dedupe keys (see MemoryJobStore) live in a second table, so repeats are matched across workers too.
+    """
+    def __init__(self, path, ttl, dedupe_ttl=0):
+        super().__init__(path)
+        self.ttl = ttl
+        self.dedupe_ttl = dedupe_ttl
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS job_keys (key TEXT PRIMARY KEY, job_id TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def save(self, job):
+        now = time.time()
+        with self._connect() as conn:
+            self._insert(conn, job, now)
+
+    def _insert(self, conn, job, now):
+        conn.execute("DELETE FROM jobs WHERE expires_at <= ?", (now,))
+        conn.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)", (job.job_id, json.dumps(job.to_dict(), default=to_json), now + self.ttl))
+
+    def claim(self, job, key):
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            # Hold the write lock so two workers can't both miss the key and start the same trip
+            conn.execute("BEGIN IMMEDIATE")
+            job_id = self._find(conn, key, now)
+            if job_id is not None:
+                return job_id
+            self._insert(conn, job, now)
+            if self.dedupe_ttl > 0:
+                conn.execute("DELETE FROM job_keys WHERE expires_at <= ?", (now,))
+                conn.execute("INSERT OR REPLACE INTO job_keys VALUES (?, ?, ?)", (key, job.job_id, now + self.dedupe_ttl))
+            return job.job_id
+
+    def find(self, key):
+        return self._find(self._connect(), key, time.time())
+
+    def _find(self, conn, key, now):
+        row = conn.execute(
+            "SELECT jobs.job_id, jobs.data FROM job_keys JOIN jobs ON jobs.job_id = job_keys.job_id"
+            " WHERE job_keys.key = ? AND job_keys.expires_at > ? AND jobs.expires_at > ?", (key, now, now)
+        ).fetchone()
+        if row is None or json.loads(row[1])["status"] == "failed":
+            return None
+        return row[0]
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT data FROM jobs WHERE job_id = ? AND expires_at > ?", (job_id, time.time())).fetchone()
+        return Job.from_dict(json.loads(row[0])) if row else None
+
+    def update(self, job_id, **fields):
+        conn = self._connect()
+        with conn:
+            # Take the write lock before reading so concurrent updates don't drop each other's fields
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is not None:
+                data = json.loads(row[0])
+                data.update(fields)
+                conn.execute("UPDATE jobs SET data = ? WHERE job_id = ?", (json.dumps(data, default=to_json), job_id))
+
+class CalendarFiles(SQLiteFile):
+    """
+    Trip calendar files linked from itinerary emails, kept in a local SQLite file so the link works
+    from any worker and keeps working after the job itself has expired.
+    """
+    def __init__(self, path, days_after_trip):
+        super().__init__(path)
+        self.days_after_trip = days_after_trip
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS calendar_files (job_id TEXT PRIMARY KEY, travel_location TEXT NOT NULL, ics TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def save(self, job_id, trip, ics):
+        # Kept until `days_after_trip` days after the trip ends
+        now = time.time()
+        trip_end = datetime.combine(trip.departure_date, datetime.min.time()).timestamp()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM calendar_files WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO calendar_files VALUES (?, ?, ?, ?)",
+                (job_id, trip.travel_location, ics, max(now, trip_end) + self.days_after_trip * 86400),
+            )
+
+    def get(self, job_id):
+        # (travel_location, ics) for the job's trip, or None
+        row = self._connect().execute(
+            "SELECT travel_location, ics FROM calendar_files WHERE job_id = ? AND expires_at > ?", (job_id, time.time())
+        ).fetchone()
+        return tuple(row) if row else None
+
+class RateLimiter:
+    """
+    Token buckets per scope and key (e.g. per user email and per client IP), kept in this process.
+    Each scope gets `burst` tokens that refill at `per_hour`; a scope with a rate of 0 is not limited.
+    Only the most recently used `max_keys` buckets are kept.
+    """
+    def __init__(self, limits, max_keys=10000):
+        # limits: {scope: (per_hour, burst)}
+        self.limits = {scope: (per_hour / 3600, max(1, burst)) for scope, (per_hour, burst) in limits.items() if per_hour > 0}
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, **keys):
+        """
+        Takes a token from the bucket of every given scope, or from none of them when one is empty.
+        Returns None when allowed, otherwise (scope, seconds until it has a token again).
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            for scope, key in keys.items():
+                if scope not in self.limits or not key:
+                    continue
+                rate, burst = self.limits[scope]
+                tokens, updated = self._buckets.pop((scope, key), (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                self._buckets[(scope, key)] = (tokens, now)
+                buckets.append(((scope, key), tokens, rate))
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            for (scope, _), tokens, rate in buckets:
+                if tokens < 1:
+                    return scope, (1 - tokens) / rate
+            for bucket, tokens, _ in buckets:
+                self._buckets[bucket] = (tokens - 1, now)
+            return None
+
+    def refund(self, **keys):
+        # Gives back the token acquire() took, e.g. when the request it was taken for did not go ahead
+        with self._lock:
+            for scope, key in keys.items():
+                bucket = self._buckets.get((scope, key))
+                if bucket is not None:
+                    tokens, updated = bucket
+                    self._buckets[(scope, key)] = (min(self.limits[scope][1], tokens + 1), updated)
+
+class ToolAuthCache:
+    """
+    Remembers completed Arcade tool authorizations per (user_id, tool_name) for a TTL.
+    Concurrent callers for the same key share a single in-flight authorization instead of each starting one,
+    even when they run on different event loops (planner threads).
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._authorized = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    async def authorize(self, client, user_id, tool_name, wait=True):
+        # With wait=False, a user who has not granted access yet raises AuthorizationPendingError instead of being waited for
+        key = (user_id, tool_name)
+        with self._lock:
+            expires_at = self._authorized.get(key)
+            if expires_at is not None and expires_at > time.monotonic():
+                return
+            future = self._in_flight.get(key) if wait else None
+            owner = wait and future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        # A quick check is not worth sharing (and must not end up waiting behind someone else's authorization)
+        if not wait:
+            with METRICS.timer("tool_authorization_seconds", tool=tool_name):
+                await authorize_tool(client, user_id, tool_name, wait=False)
+            with self._lock:
+                self._authorized[key] = time.monotonic() + self.ttl
+            return
+        # Someone else is already authorizing this key -> wait for their answer
+        # (shielded, so one waiter giving up does not cancel the authorization for the others)
+        if not owner:
+            with METRICS.timer("tool_authorization_seconds", tool=tool_name):
+                return await asyncio.shield(asyncio.wrap_future(future))
+        try:
+            with METRICS.timer("tool_authorization_seconds", tool=tool_name):
+                await authorize_tool(client, user_id, tool_name)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError(f"{tool_name} authorization was cancelled"))
+            raise
+        with self._lock:
+            self._authorized[key] = time.monotonic() + self.ttl
+            del self._in_flight[key]
+        future.set_result(None)
+
+    def invalidate(self, user_id, tool_name):
+        # Forget an authorization that stopped working (e.g. the user revoked access)
+        with self._lock:
+            self._authorized.pop((user_id, tool_name), None)
+
+class ClientRegistry:
+    """
+    Async Arcade and Anthropic clients for each event loop (every planner thread runs one; the asyncio planner
+    runs a single loop for all trips). Each keeps a pool of keep-alive HTTP connections reused by every trip on its loop.
+    Clients are built on first use and rebuilt in a child process after a fork.
+    """
+    def __init__(self, pool_size, keepalive, connect_timeout, arcade_timeout, anthropic_timeout):
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.arcade_timeout = arcade_timeout
+        self.anthropic_timeout = anthropic_timeout
+        self.reset()
+
+    def reset(self):
+        # Connections (and a lock held by another thread) must not be shared with a forked worker
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _limits(self):
+        import httpx
+        return httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+            keepalive_expiry=self.keepalive,
+        )
+
+    def _for_loop(self):
+        # Clients of the running event loop (connections cannot move between loops)
+        if self._pid != os.getpid():
+            self.reset()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            return self._loops.setdefault(loop, {})
+
+    def arcade(self):
+        clients = self._for_loop()
+        if "arcade" not in clients:
+            clients["arcade"] = self._build_arcade()
+        return clients["arcade"]
+
+    def anthropic(self):
+        clients = self._for_loop()
+        if "anthropic" not in clients:
+            clients["anthropic"] = self._build_anthropic()
+        return clients["anthropic"]
+
+    def arcade_slots(self):
+        # Arcade calls beyond the connection pool wait here rather than inside httpx,
+        # whose pool rescans every waiting request on each release (slow with hundreds of them queued)
+        clients = self._for_loop()
+        if "arcade_slots" not in clients:
+            clients["arcade_slots"] = asyncio.Semaphore(self.pool_size)
+        return clients["arcade_slots"]
+
+    def _build_arcade(self):
+        import arcadepy
+        import httpx
+        arcade_api_key, _ = get_api_keys()
+        client = arcadepy.AsyncArcade(
+            api_key=arcade_api_key,
+            http_client=arcadepy.DefaultAsyncHttpxClient(
+                limits=self._limits(),
+                timeout=httpx.Timeout(self.arcade_timeout, connect=self.connect_timeout),
+            ),
+        )
+        log.info("Arcade client initialized successfully")
+        return client
+
+    def _build_anthropic(self):
+        import anthropic
+        import httpx
+        _, anthropic_api_key = get_api_keys()
+        client = anthropic.AsyncAnthropic(
+            api_key=anthropic_api_key,
+            # Retries are handled by CLAUDE_GUARD so they respect the limiter and deadline
+            max_retries=0,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                limits=self._limits(),
+                timeout=httpx.Timeout(self.anthropic_timeout, connect=self.connect_timeout),
+            ),
+        )
+        log.info("Anthropic client initialized successfully")
+        return client
+
+class TravelEventsParser:
+    """
+    Incrementally scans the streamed travel_events tool input ({"events": [{...}, ...]})
+    and hands each event to `on_event` as soon as its closing brace arrives.
+    """
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self.emitted = 0
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._event_start = None
+        self._length = 0
+
+    def feed(self, chunk):
+        for char in chunk:
+            self._buffer.append(char)
+            self._length += 1
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+                # Objects opened directly inside the events array are events
+                if char == "{" and self._depth == 3:
+                    self._event_start = self._length - 1
+            elif char in "}]":
+                if char == "}" and self._depth == 3 and self._event_start is not None:
+                    event = json.loads("".join(self._buffer[self._event_start:]))
+                    self._event_start = None
+                    self.emitted += 1
+                    self.on_event(event)
+                self._depth -= 1
+
+class ItineraryCache(SQLiteFile):
+    """
+    Caches generated itineraries (lists of ItineraryEvent) by a hash of the Claude request, so repeated trips skip the LLM call.
+    An in-memory LRU tier sits in front of an optional SQLite tier (kept at `path`) shared by every worker on the host.
+    Entries expire after a TTL and the least recently used ones are evicted once a tier is full.
+    """
+    def __init__(self, ttl, max_entries, path=None, max_disk_entries=10000):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.path:
+            with self._connect() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS itineraries (key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS itineraries_used_at ON itineraries (used_at)")
+
+    @staticmethod
+    def make_key(request_params):
+        # Canonical hash of the prompt, model and tool schema (case and spacing in the prompt do not matter)
+        canonical = dict(request_params)
+        canonical["messages"] = [
+            dict(message, content=" ".join(message["content"].split()).casefold()) if isinstance(message["content"], str) else message
+            for message in request_params["messages"]
+        ]
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        data = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    data = entry[1]
+                else:
+                    del self._entries[key]
+        if data is None and self.path:
+            with self._connect() as conn:
+                row = conn.execute("SELECT data, expires_at FROM itineraries WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+                if row:
+                    conn.execute("UPDATE itineraries SET used_at = ? WHERE key = ?", (now, key))
+                    try:
+                        data = tuple(ItineraryEvent.from_dict(event) for event in json.loads(row[0]))
+                        self._remember(key, data, row[1])
+                    except InvalidEventError:
+                        # Written before events were validated; plan the trip again
+                        data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        log.debug(f"Itinerary cache {'hit' if data is not None else 'miss'} (hits={self.hits}, misses={self.misses})")
+        # Events are immutable, so callers share them and only get their own list
+        return list(data) if data is not None else None
+
+    def set(self, key, events):
+        data = tuple(events)
+        now = time.time()
+        expires_at = now + self.ttl
+        self._remember(key, data, expires_at)
+        if self.path:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO itineraries VALUES (?, ?, ?, ?)", (key, json.dumps([event.to_dict() for event in data]), expires_at, now))
+                conn.execute("DELETE FROM itineraries WHERE expires_at <= ?", (now,))
+                conn.execute(
+                    "DELETE FROM itineraries WHERE key IN (SELECT key FROM itineraries ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+
+    def _remember(self, key, data, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class CircuitOpenError(RuntimeError):
+    """ Raised without calling Claude while the circuit breaker is open. """
+
+class AuthorizationPendingError(RuntimeError):
+    """ Raised when a user has not authorized an Arcade tool yet; `url` is the link that lets them. """
+    def __init__(self, tool_name, url):
+        super().__init__(f"Waiting for the user to authorize {tool_name}")
+        self.url = url
+
+class StreamInterruptedError(RuntimeError):
+    """ Raised when a streamed itinerary fails after some events already went to the calendar (not safe to retry). """
+
+class SharedSlots:
+    """
+    Semaphore for coroutines on any event loop in the process: a waiting coroutine never blocks its loop,
+    and a released slot is handed to the longest waiter, whichever loop it runs on.
+    """
+    def __init__(self, size):
+        self._free = size
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    async def acquire(self, timeout=None):
+        # Returns False when no slot came free within `timeout` seconds
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._free > 0 and not self._waiters:
+                self._free -= 1
+                return True
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except BaseException as e:
+            with self._lock:
+                handed_over = (loop, waiter) not in self._waiters
+                if not handed_over:
+                    self._waiters.remove((loop, waiter))
+            # A slot handed over just before we gave up is passed on (now, or by _grant once it runs)
+            if handed_over and waiter.done() and not waiter.cancelled():
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                return False
+            raise
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                loop, waiter = self._waiters.popleft()
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(self._grant, waiter)
+                    return
+            self._free += 1
+
+    def _grant(self, waiter):
+        if waiter.done():
+            self.release()
+        else:
+            waiter.set_result(None)
+
+class ClaudeGuard:
+    """
+    Resilience layer around Claude calls. Caps in-flight requests with a semaphore, retries overload,
+    rate-limit and connection errors with jittered exponential backoff (honoring retry-after) inside
+    the trip's deadline, and opens a circuit breaker when the API keeps failing.
+    """
+    @staticmethod
+    def retryable_errors():
+        # Overload, rate-limit and connection errors (the SDK is only imported once a call has failed)
+        import anthropic
+        from anthropic._exceptions import OverloadedError
+        return (anthropic.RateLimitError, OverloadedError, anthropic.InternalServerError, anthropic.APIConnectionError)
+
+    @staticmethod
+    def answered_errors():
+        # Any other error response: the API is up and answering
+        import anthropic
+        return anthropic.APIStatusError
+
+    def __init__(self, max_inflight, max_retries, backoff_base, backoff_max, breaker_threshold, breaker_reset):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        # Shared by the event loops of every planner thread
+        self._slots = SharedSlots(max_inflight)
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self.stats = {
+            "calls": 0,
+            "retries": 0,
+            "failures": 0,
+            "rejected": 0,
+            "queue_wait_seconds": 0.0,
+            "max_queue_wait_seconds": 0.0,
+        }
+
+    async def call(self, fn, deadline=None):
+        # `fn(timeout)` is an async function making one Claude call within `timeout` seconds (None without a deadline);
+        # waiting for a slot or a retry blocks no thread
+        attempt = 0
+        while True:
+            self._before_call()
+            try:
+                result = await self._call_with_slot(fn, deadline)
+            except self.retryable_errors() as e:
+                delay = self._retry_delay(attempt, e, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            except StreamInterruptedError:
+                self._record_failure()
+                raise
+            except self.answered_errors():
+                # The API answered (e.g. a bad request), so it is not a reason to open the breaker
+                self._record_success()
+                raise
+            except BaseException:
+                # No answer at all (no free slot before the deadline, a cancelled trip or a bug on our side):
+                # it says nothing about the API, so only give up a half-open trial
+                self._end_trial()
+                raise
+            self._record_success()
+            return result
+
+    def _retry_delay(self, attempt, error, deadline):
+        # Records a retryable failure; returns how long to wait before the next attempt, or None to give up
+        self._record_failure()
+        delay = self._backoff(attempt, error)
+        out_of_time = deadline is not None and time.monotonic() + delay > deadline
+        # No point waiting to retry once the breaker has opened
+        if attempt >= self.max_retries or out_of_time or self._opened_at is not None:
+            return None
+        with self._lock:
+            self.stats["retries"] += 1
+        log.warning(f"Claude call failed ({type(error).__name__}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+        return delay
+
+    async def _call_with_slot(self, fn, deadline):
+        # Wait for a free slot, but never past the trip's deadline
+        started = time.monotonic()
+        timeout = None if deadline is None else max(0, deadline - started)
+        if not await self._slots.acquire(timeout):
+            raise TimeoutError("Timed out waiting for a free Claude slot")
+        self._record_wait(time.monotonic() - started)
+        try:
+            # The call itself only gets what is left of the deadline
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                raise TimeoutError("Trip deadline passed before the Claude call")
+            return await fn(timeout)
+        finally:
+            self._slots.release()
+
+    def _record_wait(self, waited):
+        METRICS.observe("stage_duration_seconds", waited, stage="claude_queue_wait")
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["queue_wait_seconds"] += waited
+            self.stats["max_queue_wait_seconds"] = max(self.stats["max_queue_wait_seconds"], waited)
+
+    def _backoff(self, attempt, error):
+        # Equal jitter: half the exponential step plus a random share of the other half
+        step = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        delay = step / 2 + random.uniform(0, step / 2)
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            # After the cool-down a single trial call is let through (half-open)
+            if time.monotonic() - self._opened_at < self.breaker_reset or self._trial_running:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError("Claude is unavailable right now (circuit breaker open)")
+            self._trial_running = True
+
+    def _record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            self.stats["failures"] += 1
+            # A failed half-open trial re-opens the breaker straight away
+            if self._trial_running or (self._opened_at is None and self._consecutive_failures >= self.breaker_threshold):
+                log.warning(f"Opening Claude circuit breaker after {self._consecutive_failures} failures")
+                self._opened_at = time.monotonic()
+                self._trial_running = False
+
+    def _record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def _end_trial(self):
+        # Lets the next call after the cool-down be the half-open trial instead
+        with self._lock:
+            self._trial_running = False
+
+def retry_after_seconds(error):
+    # Anthropic sends retry-after (seconds) and sometimes retry-after-ms on 429 / 529 responses
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
     try:
-        print("Loading environment variables...")
-        env_path = find_dotenv()
-        if not env_path:
-            raise FileNotFoundError(".env file not found. Please ensure it exists in the project root directory.")
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+class Outbox(SQLiteFile):
+    """
+    Durable queue of pending Gmail / Google Calendar actions, kept in a local SQLite file.
+    Actions are recorded while the itinerary is generated and a background dispatcher keeps `concurrency` of them
+    in delivery, retrying failures with backoff. Idempotency keys stop the same action from being queued twice.
+    Delivery is at-least-once: an action interrupted mid-call (e.g. by a crash) is sent again after its lease expires.
+    A trip that fails is withdrawn with cancel_job(), which also deletes the calendar events it already created.
+    Delivered, failed and cancelled actions are deleted `retention` seconds after their last attempt.
+    """
+    def __init__(self, path, batch_size, concurrency, max_attempts, lease, poll_interval, retention):
+        super().__init__(path)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._wake = threading.Event()
+        self._running = 0
+        self._running_lock = threading.Lock()
+        self._purged_at = 0.0
+        self._thread = None
+        self._thread_pid = None
+        self._start_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " idempotency_key TEXT NOT NULL UNIQUE,"
+                " job_id TEXT,"
+                " user_id TEXT NOT NULL,"
+                " tool_name TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " status TEXT NOT NULL DEFAULT 'pending',"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt_at REAL NOT NULL,"
+                " claimed_until REAL,"
+                " last_error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_ready ON outbox (status, next_attempt_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_job ON outbox (job_id)")
+            # Outboxes created before tool authorization links and created event IDs were kept
+            columns = [column[1] for column in conn.execute("PRAGMA table_info(outbox)")]
+            for column in ("auth_url", "created_id"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} TEXT")
+
+    @staticmethod
+    def idempotency_key(job_id, user_id, tool_name, payload):
+        canonical = json.dumps([job_id, user_id, tool_name, payload], sort_keys=True)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def enqueue_many(self, job_id, user_id, actions):
+        # Queues every (tool_name, payload) action in one transaction: either all of them go out or none do
+        with self._connect() as conn:
+            keys = self._insert(conn, job_id, user_id, actions, time.time())
+        self.start()
+        self._wake.set()
+        return keys
+
+    def _insert(self, conn, job_id, user_id, actions, now):
+        keys = [self.idempotency_key(job_id, user_id, tool_name, payload) for tool_name, payload in actions]
+        conn.executemany(
+            "INSERT OR IGNORE INTO outbox (idempotency_key, job_id, user_id, tool_name, payload, next_attempt_at, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(key, job_id, user_id, tool_name, json.dumps(payload), now, now, now) for key, (tool_name, payload) in zip(keys, actions)],
+        )
+        return keys
+
+    def cancel_job(self, job_id):
+        """
+        Withdraws a failed trip: its actions not sent yet never will be, and the calendar events it already created
+        are deleted again (those being created right now are deleted once they complete, see complete()).
+        """
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE outbox SET status = 'cancelled', auth_url = NULL, updated_at = ?"
+                " WHERE job_id = ? AND status IN ('pending', 'in_flight') AND tool_name != 'GoogleCalendar.DeleteEvent'",
+                (now, job_id),
+            )
+            created = conn.execute(
+                "SELECT user_id, created_id FROM outbox WHERE job_id = ? AND status = 'done' AND tool_name = 'GoogleCalendar.CreateEvent'",
+                (job_id,),
+            ).fetchall()
+            for user_id, created_id in created:
+                self._undo_created_event(conn, job_id, user_id, created_id, now)
+        self.start()
+        self._wake.set()
+
+    def _undo_created_event(self, conn, job_id, user_id, created_id, now):
+        if created_id is None:
+            log.warning(f"A calendar event of failed job {job_id} cannot be removed: its ID was not returned")
+            return
+        self._insert(conn, job_id, user_id, [("GoogleCalendar.DeleteEvent", delete_calendar_event_input(created_id))], now)
+
+    def claim(self, limit):
+        # Take up to `limit` due actions (plus any whose lease ran out) so no other dispatcher sends them
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, user_id, tool_name, payload, attempts FROM outbox"
+                " WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'in_flight' AND claimed_until <= ?)"
+                " ORDER BY id LIMIT ?",
+                (now, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET status = 'in_flight', claimed_until = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                [(now + self.lease, now, row[0]) for row in rows],
+            )
+        return [(row_id, user_id, tool_name, json.loads(payload), attempts + 1) for row_id, user_id, tool_name, payload, attempts in rows]
+
+    def complete(self, row_id, created_id=None):
+        # `created_id` is the ID of the calendar event the action created, kept so cancel_job() can delete it again
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT job_id, user_id, status FROM outbox WHERE id = ?", (row_id,)).fetchone()
+            if row is None:
+                return
+            job_id, user_id, status = row
+            if status == "cancelled":
+                # The trip failed while this was being sent, so whatever it created goes again
+                if created_id is not None:
+                    self._undo_created_event(conn, job_id, user_id, created_id, now)
+            else:
+                status = "done"
+            conn.execute(
+                "UPDATE outbox SET status = ?, created_id = ?, claimed_until = NULL, last_error = NULL, auth_url = NULL, updated_at = ? WHERE id = ?",
+                (status, created_id, now, row_id),
+            )
+        if status == "cancelled":
+            self._wake.set()
+
+    def fail(self, row_id, attempts, error, auth_url=None):
+        # `auth_url` is the link a user still has to open before the action can go out
+        now = time.time()
+        if attempts >= self.max_attempts:
+            status, next_attempt_at = "failed", now
+        else:
+            # Jittered exponential backoff before the next try
+            status, next_attempt_at = "pending", now + min(600, 5 * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+        with self._connect() as conn:
+            # A cancelled action stays cancelled
+            conn.execute(
+                "UPDATE outbox SET status = ?, next_attempt_at = ?, claimed_until = NULL, last_error = ?, auth_url = ?, updated_at = ?"
+                " WHERE id = ? AND status = 'in_flight'",
+                (status, next_attempt_at, str(error)[:1000], auth_url, now, row_id),
+            )
+
+    def purge(self):
+        # Drop finished actions past the retention period, so status counts stay cheap
+        with self._connect() as conn:
+            conn.execute("DELETE FROM outbox WHERE status IN ('done', 'failed', 'cancelled') AND updated_at <= ?", (time.time() - self.retention,))
+
+    def summary(self, job_id=None):
+        # Counts by status for one job (or the whole outbox)
+        if job_id is None:
+            rows = self._connect().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        else:
+            rows = self._connect().execute("SELECT status, COUNT(*) FROM outbox WHERE job_id = ? GROUP BY status", (job_id,)).fetchall()
+        return dict(rows)
+
+    def authorization_urls(self, job_id):
+        # Links the user still has to open before the job's queued actions can be delivered
+        rows = self._connect().execute(
+            "SELECT DISTINCT auth_url FROM outbox WHERE job_id = ? AND status = 'pending' AND auth_url IS NOT NULL", (job_id,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def start(self):
+        # One dispatcher thread per process (threads do not survive a fork, so check the pid too)
+        if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive() or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def _run(self):
+        # Keeps every worker busy: as soon as one delivery finishes, the next due action is claimed for it
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="outbox") as pool:
+            while True:
+                # Cleared before looking for work, so a wake-up that comes in meanwhile is not lost
+                self._wake.clear()
+                self._purge_if_due()
+                free = self.concurrency - self._running
+                batch = []
+                if free > 0:
+                    try:
+                        batch = self.claim(min(free, self.batch_size))
+                    except Exception as e:
+                        log.exception(f"Outbox claim failed: {e}")
+                if not batch:
+                    # Nothing due or every worker busy: wait for a new action, a finished delivery or the next poll
+                    self._wake.wait(self.poll_interval)
+                    continue
+                log.debug(f"Delivering {len(batch)} queued actions")
+                with self._running_lock:
+                    self._running += len(batch)
+                for item in batch:
+                    pool.submit(self._deliver, *item).add_done_callback(self._delivered)
+
+    def _delivered(self, future):
+        with self._running_lock:
+            self._running -= 1
+        self._wake.set()
+
+    def _purge_if_due(self):
+        if self.retention <= 0 or time.monotonic() - self._purged_at < 60:
+            return
+        self._purged_at = time.monotonic()
+        try:
+            self.purge()
+        except Exception as e:
+            log.warning(f"Outbox cleanup failed: {e}")
+
+    def _deliver(self, row_id, user_id, tool_name, payload, attempts):
+        try:
+            response = run_on_thread_loop(self._send, user_id, tool_name, payload)
+        except AuthorizationPendingError as e:
+            # Retried with backoff; meanwhile the job status shows the user the link
+            log.info(f"Queued {tool_name} for {user_id} is waiting for authorization (attempt {attempts}/{self.max_attempts})")
+            self._record(self.fail, row_id, attempts, e, auth_url=e.url)
+        except Exception as e:
+            log.warning(f"Queued {tool_name} for {user_id} failed (attempt {attempts}/{self.max_attempts}): {e}")
+            METRICS.inc("retries_total" if attempts < self.max_attempts else "errors_total", stage="outbox")
+            self._record(self.fail, row_id, attempts, e)
+        else:
+            self._record(self.complete, row_id, created_event_id(response) if tool_name == "GoogleCalendar.CreateEvent" else None)
+
+    @staticmethod
+    def _record(update, row_id, *args, **kwargs):
+        # A status write that fails (e.g. "database is locked") must not take the worker down with it;
+        # the action stays in flight and is sent again once its lease runs out
+        try:
+            update(row_id, *args, **kwargs)
+        except Exception as e:
+            log.exception(f"Could not record the outcome of queued action {row_id}: {e}")
+
+    @staticmethod
+    async def _send(user_id, tool_name, payload):
+        client = CLIENTS.arcade()
+        # Never wait here for a user to authorize: one who never does would hold a worker (and everyone behind it)
+        await TOOL_AUTH_CACHE.authorize(client, user_id, tool_name, wait=False)
+        return await execute_tool(client, user_id, tool_name, payload)
+
+_thread_loops = threading.local()
+
+def run_on_thread_loop(fn, *args):
+    """
+    Runs the coroutine function `fn(*args)` to completion on this thread's own event loop, created on first use
+    and kept for the next call so the API clients built for it keep their connections (see ClientRegistry).
+    """
+    loop = getattr(_thread_loops, "loop", None)
+    if loop is None:
+        loop = _thread_loops.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(fn(*args))
+
+class AsyncPlanner:
+    """
+    Runs planner jobs as tasks on one background event loop, at most `max_workers` at a time.
+    submit() is called from request threads, like ThreadPoolExecutor.submit() with a coroutine function.
+    The loop thread is started on first use and again in a child process after a fork.
+    """
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._loop = None
+        self._slots = None
+        self._pid = None
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._slots = None
+                self._pid = os.getpid()
+                threading.Thread(target=self._loop.run_forever, name="planner-loop", daemon=True).start()
+            return self._loop
+
+    def submit(self, fn, *args):
+        return asyncio.run_coroutine_threadsafe(self._run(fn, *args), self._start())
+
+    async def _run(self, fn, *args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        async with self._slots:
+            return await fn(*args)
+
+def make_job_store():
+    # Pick the store from the environment: "memory" (default, single process) or "sqlite" (shared between workers)
+    kind = os.getenv("JOB_STORE", "memory").lower()
+    ttl = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+    # Repeat submissions of the same trip by the same user attach to its job for this long
+    dedupe_ttl = int(os.getenv("JOB_DEDUPE_SECONDS", "900"))
+    if kind == "sqlite":
+        return SQLiteJobStore(os.getenv("JOB_STORE_PATH", "jobs.db"), ttl, dedupe_ttl)
+    if kind != "memory":
+        raise ConfigError(f"Unknown JOB_STORE '{kind}', expected 'memory' or 'sqlite'")
+    return MemoryJobStore(ttl, dedupe_ttl)
+
+# Claude model used for every itinerary call
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+
+_configured = False
+_configure_lock = threading.Lock()
+_env_loaded = False
+
+class ConfigError(RuntimeError):
+    """ Raised when a setting is missing or invalid (e.g. no API keys). """
+
+def load_env():
+    # Settings can come from a .env file next to the app; real environment variables win
+    global _env_loaded
+    if _env_loaded:
+        return
+    from dotenv import load_dotenv, find_dotenv
+    env_path = find_dotenv()
+    if env_path:
         load_dotenv(dotenv_path=Path(env_path))
-        # Fetch API keys from environment variables
-        arcade_api_key = os.getenv("ARCADE_API_KEY")
-        openai_api_key = os.getenv("OPENAI_API_KEY")
-        anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-        # Check if the API keys are not None or empty
-        if not arcade_api_key or not anthropic_api_key:
-            raise ValueError("One or more API keys are missing. Please check your .env file.")
-        print("Environment variables loaded successfully.")
-        return arcade_api_key, anthropic_api_key
-    except Exception as e:
-        print(f"Error loading environment variables: {e}")
-        traceback.print_exc()
-        sys.exit(1) 
+    _env_loaded = True
+
+def configure():
+    """
+    Reads the settings (from the environment and the .env file) and builds the shared components:
+    planner pool, Claude guard, caches, outbox, API client registry and job store.
+    Runs once per process, on the first create_app() call; later calls return straight away.
+    """
+    global _configured
+    global PLANNER_RUNTIME, PLANNER_WORKERS, PLANNER_QUEUE_SIZE, planner_pool, planner_slots, JOB_STORE
+    global PLANNER_MODE, PLAN_DAY_CONCURRENCY, MAX_TRIP_DAYS, CLAUDE_GUARD, PLAN_DEADLINE_SECONDS, ITINERARY_CACHE, STREAM_ITINERARY
+    global CALENDAR_CONCURRENCY, CALENDAR_EXPORT, PUBLIC_BASE_URL, CALENDAR_FILES, EMAIL_FORMAT, DELIVERY_MODE, OUTBOX, TOOL_AUTH_CACHE, CLIENTS
+    global RATE_LIMITER
+    with _configure_lock:
+        if _configured:
+            return
+        load_env()
+        # Background planning jobs (always async code): "threads" runs each trip on a worker thread's own event loop;
+        # "asyncio" runs every trip as a task on one event loop, so waiting on Claude or Arcade costs no thread
+        PLANNER_RUNTIME = os.getenv("PLANNER_RUNTIME", "threads").lower()
+        if PLANNER_RUNTIME not in ("threads", "asyncio"):
+            raise ConfigError(f"Unknown PLANNER_RUNTIME '{PLANNER_RUNTIME}', expected 'threads' or 'asyncio'")
+        # Bounded pool so only PLANNER_WORKERS trips run at once; the rest wait in a capped queue
+        PLANNER_WORKERS = int(os.getenv("PLANNER_WORKERS", "4" if PLANNER_RUNTIME == "threads" else "256"))
+        PLANNER_QUEUE_SIZE = int(os.getenv("PLANNER_QUEUE_SIZE", "32"))
+        if PLANNER_RUNTIME == "asyncio":
+            planner_pool = AsyncPlanner(PLANNER_WORKERS)
+        else:
+            planner_pool = ThreadPoolExecutor(max_workers=PLANNER_WORKERS, thread_name_prefix="planner")
+        planner_slots = threading.BoundedSemaphore(PLANNER_WORKERS + PLANNER_QUEUE_SIZE)
+        # New trips each user email and client IP may start, as an hourly rate plus a burst (repeats of a queued trip are free)
+        RATE_LIMITER = RateLimiter({
+            "user": (float(os.getenv("RATE_LIMIT_USER_PER_HOUR", "10")), int(os.getenv("RATE_LIMIT_USER_BURST", "3"))),
+            "ip": (float(os.getenv("RATE_LIMIT_IP_PER_HOUR", "30")), int(os.getenv("RATE_LIMIT_IP_BURST", "10"))),
+        })
+        # Calendar events written at the same time for a single trip
+        CALENDAR_CONCURRENCY = int(os.getenv("CALENDAR_CONCURRENCY", "8"))
+        # "single" plans the whole trip in one Claude call (capped at 5 days so the AI isn't overwhelmed);
+        # "per_day" plans transport/lodging first and then every day in parallel, so longer trips take about as long
+        PLANNER_MODE = os.getenv("PLANNER_MODE", "single").lower()
+        if PLANNER_MODE not in ("single", "per_day"):
+            raise ConfigError(f"Unknown PLANNER_MODE '{PLANNER_MODE}', expected 'single' or 'per_day'")
+        PLAN_DAY_CONCURRENCY = int(os.getenv("PLAN_DAY_CONCURRENCY", "4"))
+        MAX_TRIP_DAYS = int(os.getenv("MAX_TRIP_DAYS", "5" if PLANNER_MODE == "single" else "14"))
+        # Limits and retries for Claude calls (each trip gets PLAN_DEADLINE_SECONDS to get its itinerary)
+        CLAUDE_GUARD = ClaudeGuard(
+            max_inflight=int(os.getenv("CLAUDE_MAX_INFLIGHT", "4")),
+            max_retries=int(os.getenv("CLAUDE_MAX_RETRIES", "4")),
+            backoff_base=float(os.getenv("CLAUDE_BACKOFF_BASE_SECONDS", "1")),
+            backoff_max=float(os.getenv("CLAUDE_BACKOFF_MAX_SECONDS", "30")),
+            breaker_threshold=int(os.getenv("CLAUDE_BREAKER_THRESHOLD", "5")),
+            breaker_reset=float(os.getenv("CLAUDE_BREAKER_RESET_SECONDS", "30")),
+        )
+        PLAN_DEADLINE_SECONDS = float(os.getenv("PLAN_DEADLINE_SECONDS", "180"))
+        # Generated itineraries are reused for identical trips (set ITINERARY_CACHE_PATH to share them through SQLite)
+        ITINERARY_CACHE = ItineraryCache(
+            ttl=int(os.getenv("ITINERARY_CACHE_TTL_SECONDS", "86400")),
+            max_entries=int(os.getenv("ITINERARY_CACHE_SIZE", "256")),
+            path=os.getenv("ITINERARY_CACHE_PATH"),
+            max_disk_entries=int(os.getenv("ITINERARY_CACHE_DISK_SIZE", "10000")),
+        )
+        # How itineraries reach the calendar: "events" (one CreateEvent call per event) or "ics" (one .ics file per trip)
+        CALENDAR_EXPORT = os.getenv("CALENDAR_EXPORT", "events").lower()
+        if CALENDAR_EXPORT not in ("events", "ics"):
+            raise ConfigError(f"Unknown CALENDAR_EXPORT '{CALENDAR_EXPORT}', expected 'events' or 'ics'")
+        # Public address of this site, used for links in emails (e.g. https://trips.example.com)
+        PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+        # Calendar files linked from emails outlive their job (only kept when there is a link to put in the email)
+        CALENDAR_FILES = CalendarFiles(
+            os.getenv("CALENDAR_FILES_PATH", "calendars.db"),
+            days_after_trip=int(os.getenv("CALENDAR_LINK_DAYS", "30")),
+        ) if PUBLIC_BASE_URL else None
+        # Itinerary email body: "text" (plain text) or "html"
+        EMAIL_FORMAT = os.getenv("EMAIL_FORMAT", "text").lower()
+        if EMAIL_FORMAT not in ("text", "html"):
+            raise ConfigError(f"Unknown EMAIL_FORMAT '{EMAIL_FORMAT}', expected 'text' or 'html'")
+        # Email and calendar side effects: "outbox" (queued durably and delivered in the background) or "inline" (sent before the job finishes)
+        DELIVERY_MODE = os.getenv("DELIVERY_MODE", "outbox").lower()
+        if DELIVERY_MODE not in ("outbox", "inline"):
+            raise ConfigError(f"Unknown DELIVERY_MODE '{DELIVERY_MODE}', expected 'outbox' or 'inline'")
+        OUTBOX = Outbox(
+            os.getenv("OUTBOX_PATH", "outbox.db"),
+            batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", "20")),
+            concurrency=int(os.getenv("OUTBOX_CONCURRENCY", "8")),
+            max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8")),
+            lease=float(os.getenv("OUTBOX_LEASE_SECONDS", "300")),
+            poll_interval=float(os.getenv("OUTBOX_POLL_SECONDS", "2")),
+            retention=float(os.getenv("OUTBOX_RETENTION_SECONDS", "86400")),
+        ) if DELIVERY_MODE == "outbox" else None
+        # Stream the itinerary from Claude so events show up (and reach the calendar) while later ones are still being written
+        STREAM_ITINERARY = os.getenv("STREAM_ITINERARY", "1").lower() not in ("0", "false", "no")
+        # Arcade tool authorizations are checked once per user and tool, then reused for this long
+        TOOL_AUTH_CACHE = ToolAuthCache(int(os.getenv("TOOL_AUTH_TTL_SECONDS", "1800")))
+        # Long-lived API clients shared by every trip in this process
+        CLIENTS = ClientRegistry(
+            pool_size=int(os.getenv("HTTP_POOL_SIZE", "20")),
+            keepalive=float(os.getenv("HTTP_KEEPALIVE_SECONDS", "30")),
+            connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "10")),
+            arcade_timeout=float(os.getenv("ARCADE_TIMEOUT_SECONDS", "60")),
+            anthropic_timeout=float(os.getenv("ANTHROPIC_TIMEOUT_SECONDS", "600")),
+        )
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=CLIENTS.reset)
+        JOB_STORE = make_job_store()
+        _configured = True
 
-# Construct Flask app for user interface
-app = Flask(__name__, template_folder='templates')
-app.secret_key = os.getenv("SECRET_KEY", "bpSOP_\xc5r\xa2H\x15\xaa\x12\r8]\xb1\x02\x15\xfe\xfd\x9d\xf9\xf0\xdb\xcek")
+def collect_component_stats():
+    # Numbers the itinerary cache, token counters and Claude guard already keep, read at scrape time
+    with TOKEN_USAGE_STATS_LOCK:
+        tokens = dict(TOKEN_USAGE_STATS)
+    with CLAUDE_GUARD._lock:
+        guard = dict(CLAUDE_GUARD.stats)
+    stats = [
+        ("itinerary_cache_requests_total", "counter", "Itinerary cache lookups by result",
+         [({"result": "hit"}, ITINERARY_CACHE.hits), ({"result": "miss"}, ITINERARY_CACHE.misses)]),
+        ("claude_requests_total", "counter", "Claude responses with token usage", [({}, tokens["requests"])]),
+        ("claude_tokens_total", "counter", "Claude tokens by kind",
+         [({"kind": "input"}, tokens["input_tokens"]), ({"kind": "output"}, tokens["output_tokens"])]),
+        ("claude_calls_total", "counter", "Claude calls that got a slot", [({}, guard["calls"])]),
+        ("claude_retries_total", "counter", "Claude calls retried after overload, rate-limit or connection errors", [({}, guard["retries"])]),
+        ("claude_failures_total", "counter", "Failed Claude calls (before retries)", [({}, guard["failures"])]),
+        ("claude_rejected_total", "counter", "Claude calls refused by the open circuit breaker", [({}, guard["rejected"])]),
+        ("claude_queue_wait_seconds_max", "gauge", "Longest wait for a free Claude slot", [({}, guard["max_queue_wait_seconds"])]),
+        ("claude_circuit_open", "gauge", "1 while the Claude circuit breaker is open", [({}, int(CLAUDE_GUARD._opened_at is not None))]),
+    ]
+    if OUTBOX is not None:
+        stats.append(("outbox_actions", "gauge", "Queued email and calendar actions by status",
+                      [({"status": status}, count) for status, count in OUTBOX.summary().items()]))
+    return stats
 
-# Make sure templates exist
-template_path = os.path.join('templates', '500.html')
-print(f"Template path: {template_path}")
-print(f"Template exists: {os.path.exists(template_path)}")
+METRICS.add_collector(collect_component_stats)
 
-# Get API Keys
-arcade_api_key, anthropic_api_key = get_api_keys()
+# API keys from the environment (or the .env file), checked when the app is created
+def get_api_keys():
+    load_env()
+    arcade_api_key = os.getenv("ARCADE_API_KEY")
+    anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
+    # Check if the API keys are not None or empty
+    if not arcade_api_key or not anthropic_api_key:
+        raise ConfigError("ARCADE_API_KEY and ANTHROPIC_API_KEY must be set (in the environment or the .env file).")
+    return arcade_api_key, anthropic_api_key
+
+def create_app():
+    """
+    Builds the Flask app for the user interface: loads and checks the configuration, starts the
+    background threads (log writer, outbox dispatcher) and registers every route.
+    Raises ConfigError when a required setting is missing.
+    """
+    configure()
+    setup_logging(os.getenv("LOG_LEVEL", "INFO").upper())
+    get_api_keys()
+    log.info("Configuration loaded successfully.")
+    if OUTBOX is not None:
+        # Deliver anything left queued by a previous run
+        OUTBOX.start()
+
+    app = Flask(__name__, template_folder='templates')
+    # Behind reverse proxies, take the client IP (used for rate limits) from the X-Forwarded-For they add
+    proxies = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+    if proxies:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies)
+    app.secret_key = os.getenv("SECRET_KEY", "bpSOP_\xc5r\xa2H\x15\xaa\x12\r8]\xb1\x02\x15\xfe\xfd\x9d\xf9\xf0\xdb\xcek")
+    app.add_url_rule('/', 'home', home)
+    app.add_url_rule('/planner', 'base', base, methods=['POST', 'GET'])
+    app.add_url_rule('/api/cities', 'city_suggestions', city_suggestions)
+    app.add_url_rule('/loading', 'loading', loading)
+    app.add_url_rule('/loading/<job_id>', 'loading', loading)
+    app.add_url_rule('/backend_processing', 'backend_processing', backend_processing)
+    app.add_url_rule('/api/job_status/<job_id>', 'job_status', job_status)
+    app.add_url_rule('/trip_results/<job_id>', 'trip_results', trip_results)
+    app.add_url_rule('/trip_results/<job_id>/itinerary.ics', 'trip_calendar', trip_calendar)
+    app.add_url_rule('/submitted', 'submitted', submitted)
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    app.register_error_handler(404, not_found_error)
+    app.register_error_handler(500, internal_error)
+    return app
+
+_default_app = None
+_default_app_lock = threading.Lock()
+
+def __getattr__(name):
+    # `main.app` (e.g. for gunicorn main:app) builds the default app on first use
+    global _default_app
+    if name == "app":
+        with _default_app_lock:
+            if _default_app is None:
+                _default_app = create_app()
+        return _default_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Rendering the template for the Flask homepage
-@app.route('/')
 def home():
     return render_template('welcome.html')
 
 # UI to process trip information
-@app.route('/planner', methods=['POST', 'GET'])
 def base():
-    global MY_TRIP
     if request.method == 'POST':
+        from email_validator import validate_email, EmailNotValidError
         try:
             # Get all form data first
             user_email = request.form.get('user_email')
@@ -99,6 +1445,7 @@ def base():
                 'arrival_date', 'departure_date'
             ]
 
+            validation_started = time.perf_counter()
             # Validate email
             if not user_email:
                 flash("Email is required")
@@ -135,10 +1482,10 @@ def base():
                 flash("Arrival date must be before departure date")
                 return render_template('planner.html')
             
-            # Limit the time frame for the trip to 5 days
+            # Limit the time frame for the trip (5 days unless PLANNER_MODE=per_day)
                 # Cannot overwhelm AI (considerations on budget and run-time // error of correctly utilizing tools as well for longer trips)
-            if (departure_date - arrival_date) > timedelta(days=5):
-                flash("Stay cannot exceed 5 days!")
+            if (departure_date - arrival_date) > timedelta(days=MAX_TRIP_DAYS):
+                flash(f"Stay cannot exceed {MAX_TRIP_DAYS} days!")
                 return render_template('planner.html')
 
             # Ensure the dates are valid -- travel dates must be in the present or future 
@@ -151,7 +1498,7 @@ def base():
                 travel_preferences = None
 
             # Pass validation information  
-            MY_TRIP = trip(
+            new_trip = Trip(
                 user_email,
                 start_location, 
                 travel_location, 
@@ -165,156 +1512,412 @@ def base():
                 travel_preferences
             )
 
-            # Process the trip information
-            return redirect(url_for('loading'))
+            METRICS.observe("stage_duration_seconds", time.perf_counter() - validation_started, stage="validation")
+
+            # A repeat of a trip that is queued, running or done goes to that job instead of planning it again
+            dedupe_key = new_trip.fingerprint()
+            job_id = JOB_STORE.find(dedupe_key)
+            limited = None
+            rate_keys = {"user": user_email.strip().casefold(), "ip": request.remote_addr}
+            if job_id is None:
+                limited = RATE_LIMITER.acquire(**rate_keys)
+                # A concurrent identical submission may have queued the trip in the meantime
+                job_id = JOB_STORE.find(dedupe_key) if limited else None
+            if job_id is not None:
+                log.info(f"Trip already submitted -> attaching to job {job_id}")
+                METRICS.inc("trip_submissions_total", result="duplicate")
+            elif limited is not None:
+                scope, retry_after = limited
+                log.warning(f"Rate limit reached for {scope} -> rejecting trip")
+                METRICS.inc("trip_submissions_total", result="rate_limited")
+                flash(f"You have planned a lot of trips recently. Please try again in {max(1, round(retry_after / 60))} minutes.", 'error')
+                return render_template('planner.html'), 429, {"Retry-After": str(int(retry_after) + 1)}
+            else:
+                # Queue the trip for the planner workers and hand back a job ID right away
+                job_id, queued = submit_job(new_trip, dedupe_key)
+                if not queued:
+                    # Only trips that actually start count against the limits (not a full queue or an identical trip)
+                    RATE_LIMITER.refund(**rate_keys)
+                if job_id is None:
+                    flash("Our travel planner is busy right now. Please try again in a few minutes.", 'error')
+                    return render_template('planner.html'), 503, {"Retry-After": "60"}
+            session['job_id'] = job_id
+            return redirect(url_for('loading', job_id=job_id))
         except EmailNotValidError as e: 
             flash("Invalid email address format", 'error')
         except ValueError as e:
             flash(str(e), 'error')
         except Exception as e:
+            METRICS.inc("errors_total", stage="validation")
             flash("An unexpected error occurred. Please try again.", 'error')
             # Log the actual error for debugging
-            print(f"Unexpected error in base route: {e}")
+            log.exception(f"Unexpected error in base route: {e}")
         #  Error handling - render form again
         return render_template('planner.html')
     # GET request - show the form
     return render_template('planner.html')
 
-@app.route('/loading')
-def loading():
-    # Ensure the object data is correctly stored
-    if not MY_TRIP: 
-        print('No Trip Validated')
-        return redirect(url_for('planner')) # Redirect back to planner if necessary
-    # Proceed to loading page
-    return render_template('loading.html')
+def city_suggestions():
+    # Autocomplete for the planner form: prefix matches (plus close spellings) from the shared city index
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 20))
+    try:
+        results = CITY_INDEX.complete(query, limit=limit) if len(query.strip()) >= 2 else []
+    except FileNotFoundError:
+        log.error(f"Error: The file '{CITY_INDEX.path}' was not found.")
+        results = []
+    response = jsonify({"query": query, "results": results})
+    # Suggestions only change with cities.json, so browsers can reuse them
+    response.headers["Cache-Control"] = "public, max-age=3600"
+    return response
+
+def loading(job_id=None):
+    # Fall back to the trip submitted in this browser session
+    job_id = job_id or session.get('job_id')
+    # Ensure the job exists before polling it
+    if not job_id or get_job(job_id) is None:
+        log.warning('No Trip Validated')
+        return redirect(url_for('base')) # Redirect back to planner if necessary
+    # Proceed to loading page (it polls /api/job_status until the job finishes)
+    return render_template('loading.html', job_id=job_id)
 
-@app.route('/backend_processing')
 def backend_processing():
     """
-    This function executes all the backend which includes calling Anthropic's API and using Arcade to authorize the user's email and Google Calendar. 
-    It then conducts multiple tool executions
+    Kept for old links and bookmarks. Planning now runs on the background worker pool (see run_job),
+    so this just sends the user back to the loading page for their current job.
     """
-    try:
-        process_backend()
-        return redirect(url_for('submitted'))
-    except Exception as e:
-        print(f"Backend processing failed: {e}")
-        # Trigger the 500 error handler
-        return render_template('500.html'), 500
+    return redirect(url_for('loading'))
 
-@app.route('/submitted')
-def submitted():
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"job_id": job_id, "status": "failed", "error": "We could not find this trip. Please plan it again."}), 404
+    status = job.to_status()
+    if OUTBOX is not None:
+        # Counts of queued email / calendar actions by state (pending, in_flight, done, failed)
+        status["delivery"] = OUTBOX.summary(job_id)
+        # Actions held up until the user grants access (see Outbox._send)
+        status["authorization_urls"] = OUTBOX.authorization_urls(job_id)
+    return jsonify(status)
+
+def trip_results(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return redirect(url_for('base'))
+    # Still planning -> keep the user on the loading page
+    if job.status != "completed":
+        return redirect(url_for('loading', job_id=job_id))
     try:
         # Showing all important trip information in terminal
-        print("trip info: ", MY_TRIP)
-        print(f"Trip details: {MY_TRIP.user_email}, {MY_TRIP.start_location} -> {MY_TRIP.travel_location}")
-        print(f"Dates: {MY_TRIP.arrival_date} to {MY_TRIP.departure_date}")
-        print(f"Passengers: {MY_TRIP.passenger_adult_count} adults, {MY_TRIP.passenger_child_count} children")
+        my_trip = job.trip
+        log.debug(f"Trip details: {my_trip.user_email}, {my_trip.start_location} -> {my_trip.travel_location}")
+        log.debug(f"Dates: {my_trip.arrival_date} to {my_trip.departure_date}")
+        log.debug(f"Passengers: {my_trip.passenger_adult_count} adults, {my_trip.passenger_child_count} children")
 
-        return render_template('submitted.html')
+        # Queued deliveries waiting for the user to grant Gmail / Google Calendar access
+        authorization_urls = OUTBOX.authorization_urls(job_id) if OUTBOX is not None else []
+        return render_template('submitted.html', trip=my_trip, result=job.result, ics_url=url_for('trip_calendar', job_id=job_id),
+                               authorization_urls=authorization_urls)
     except Exception as e:
-        print(f"Error processing trip: {e}")
-        print(f"Error type: {type(e)}")
-        traceback.print_exc()
+        log.exception(f"Error processing trip ({type(e).__name__}): {e}")
         flash("An error occurred while processing your trip.", 'error')
         return redirect(url_for('home'))
 
+def trip_calendar(job_id):
+    # Whole trip as one calendar file (works in either CALENDAR_EXPORT mode)
+    job = get_job(job_id)
+    if job is not None and job.status == "completed":
+        travel_location, ics = job.trip.travel_location, build_trip_ics(job.trip, job.result["itinerary"], uid_prefix=job_id)
+    else:
+        # The link in the email keeps working once the job is gone (see CalendarFiles)
+        saved = CALENDAR_FILES.get(job_id) if CALENDAR_FILES is not None else None
+        if saved is None:
+            return render_template('404.html'), 404
+        travel_location, ics = saved
+    filename = "trip-to-" + "-".join(travel_location.lower().split()) + ".ics"
+    # send_file adds an ASCII fallback for names like "Łódź", which a plain header can't carry
+    return send_file(io.BytesIO(ics.encode()), mimetype="text/calendar", as_attachment=True, download_name=filename)
+
+def submitted():
+    # Results now live under the job they belong to
+    job_id = session.get('job_id')
+    if not job_id:
+        return redirect(url_for('home'))
+    return redirect(url_for('trip_results', job_id=job_id))
+
+def metrics():
+    # Prometheus scrape endpoint (numbers are per server process)
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
 # 404 Error Handler
-@app.errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
 
 # 500 Error Handler
-@app.errorhandler(500)
 def internal_error(error):
     return render_template('500.html'), 500
 
-def process_backend():
-    global client, MY_TRIP, anthropic_client, USER_ID
+def get_job(job_id):
+    return JOB_STORE.get(job_id)
+
+def submit_job(my_trip, dedupe_key=None):
+    """
+    Queues a validated trip on the planner worker pool. Returns (job ID, True) once queued,
+    or (None, False) when the queue is already full.
+    With a dedupe key, a live job already holding the key is returned instead, as (its job ID, False).
+    """
+    if not planner_slots.acquire(blocking=False):
+        log.warning("Planner queue is full -> rejecting trip")
+        METRICS.inc("trip_submissions_total", result="rejected")
+        return None, False
+    job = Job(uuid.uuid4().hex, my_trip)
+    if dedupe_key is None:
+        JOB_STORE.save(job)
+        holder = job.job_id
+    else:
+        holder = JOB_STORE.claim(job, dedupe_key)
+    if holder != job.job_id:
+        # An identical submission got there first
+        planner_slots.release()
+        METRICS.inc("trip_submissions_total", result="duplicate")
+        return holder, False
     try:
-        client = Arcade() # Automatically finds the `ARCADE_API_KEY` env variable
-        print("Arcade client initialized successfully")
+        planner_pool.submit(run_job if PLANNER_RUNTIME == "asyncio" else run_job_on_thread, job.job_id)
+    except Exception:
+        planner_slots.release()
+        raise
+    log.info(f"Queued job {job.job_id}")
+    METRICS.inc("trip_submissions_total", result="queued")
+    return job.job_id, True
+
+def run_job_on_thread(job_id):
+    # Entry point on a planner worker thread (PLANNER_RUNTIME=threads): the job runs on the thread's event loop
+    run_on_thread_loop(run_job, job_id)
+
+async def run_job(job_id):
+    # Runs as a task on a planner event loop; all state lives in the job store, keyed by job ID
+    try:
+        job, progress = await start_job(job_id)
+        if job is None:
+            return
+        try:
+            with METRICS.timer("stage_duration_seconds", stage="job"):
+                result = await process_backend(job.trip, progress=progress, job_id=job_id)
+        finally:
+            # Progress writes still in flight must not land after the final status
+            await progress.wait()
+        await complete_job(job_id, result)
+    except Exception as e:
+        await fail_job(job_id, e)
+    finally:
+        planner_slots.release()
+
+async def start_job(job_id):
+    # Marks a queued job as running; returns it with its progress callback, or (None, None) once it expired
+    job = await asyncio.to_thread(JOB_STORE.get, job_id)
+    if job is None:
+        log.warning(f"Job {job_id} expired before it could run")
+        return None, None
+    await asyncio.to_thread(JOB_STORE.update, job_id, status="running", message="Planning your adventure...")
+    METRICS.observe("stage_duration_seconds", max(0, time.time() - job.created_at), stage="job_queue_wait")
+    return job, JobProgress(job_id)
+
+async def complete_job(job_id, result):
+    await asyncio.to_thread(JOB_STORE.update, job_id, status="completed", message="Your trip is ready!", result=result)
+    METRICS.inc("jobs_total", status="completed")
+
+async def fail_job(job_id, error):
+    log.error(f"Job {job_id} failed: {error}")
+    METRICS.inc("jobs_total", status="failed")
+    await asyncio.to_thread(
+        JOB_STORE.update,
+        job_id,
+        status="failed",
+        message="Something went wrong while planning your trip.",
+        error="We could not generate your trip. Please try again in a few minutes.",
+    )
+
+class JobProgress:
+    """
+    Progress callback for a running job: progress(message=None, **fields) updates its status in the job store.
+    Writes run off the event loop, one at a time; updates made while one is running are merged into the next,
+    so a fast stream of events costs a few writes rather than one each.
+    """
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self._pending = {}
+        self._writer = None
+
+    def __call__(self, message=None, **fields):
+        if message:
+            fields["message"] = message
+        self._pending.update(fields)
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write())
+
+    async def _write(self):
+        while self._pending:
+            fields, self._pending = self._pending, {}
+            await asyncio.to_thread(JOB_STORE.update, self.job_id, **fields)
+
+    async def wait(self):
+        if self._writer is not None:
+            await self._writer
+
+async def process_backend(my_trip, progress=None, job_id=None):
+    # Progress updates are optional (shown on the loading page when running as a job)
+    progress = progress or (lambda message=None, **fields: None)
+    calendar = None
+    enqueued = []
+    try:
+        # Shared clients reuse their open connections across trips
+        client = CLIENTS.arcade()
+        anthropic_client = CLIENTS.anthropic()
         
         # Pass a unique identifier for them (e.g. an email or user ID) to Arcade:
-        USER_ID = MY_TRIP.user_email
-        print(f"User ID set to: {USER_ID}")
+        user_id = my_trip.user_email
+        log.debug(f"User ID set to: {user_id}")
 
-        # Initialize Anthropic client
-        anthropic_client = anthropic.Client(
-            api_key=anthropic_api_key
-        )
-        print("Anthropic client initialized successfully")
-        
-        print("Starting the trip planning process...")
+        log.info("Starting the trip planning process...")
+
+        # Start writing each event to the calendar as soon as Claude finishes it
+        # (in "ics" mode the whole trip is one downloadable file instead); if the plan then fails, they are removed again
+        if CALENDAR_EXPORT == "events" and OUTBOX is None:
+            calendar = CalendarWriter(client, user_id)
+        planned_events = []
+
+        def on_event(event):
+            if calendar is not None:
+                calendar.submit(event)
+            elif CALENDAR_EXPORT == "events":
+                enqueued.append(asyncio.ensure_future(asyncio.to_thread(
+                    OUTBOX.enqueue_many, job_id, user_id, [("GoogleCalendar.CreateEvent", calendar_tool_input(event, user_id))]
+                )))
+            planned_events.append(event.event_name)
+            progress(planned_events=list(planned_events))
 
         # Get the travel plan
-        print("Calling get_anthropic_plan...")
-        result = get_anthropic_plan(MY_TRIP)
-        print(f"get_anthropic_plan returned: {type(result)}")
+        log.debug("Calling get_anthropic_plan...")
+        progress("Creating your personalized itinerary...")
+        deadline = time.monotonic() + PLAN_DEADLINE_SECONDS
+        with METRICS.timer("stage_duration_seconds", stage="plan"):
+            result = await get_anthropic_plan(my_trip, anthropic_client, on_event=on_event, deadline=deadline)
+        log.debug(f"get_anthropic_plan returned: {type(result)}")
         
         # Redirect to Error
         if result is None:
             raise Exception("Failed to generate plan")
 
-        # Show some event names on the Terminal
         if result:
-            print(f"Generated itinerary with {result['event_count']} events")
-            print("First few events:")
-            for i, event in enumerate(result["itinerary"][:3]):
-                print(f"  Event {i+1}: {event.get('event_name', 'No name')}") 
-            # Send the email with trip details
-            send_email(trip=MY_TRIP, result=result)
-            # Add a Calendar Event
-            for event in result["itinerary"]:
-                add_calendar_event(client, event)
-            print("Calendar events added successfully.")
+            await asyncio.gather(*enqueued)
+            if await finish_plan(my_trip, result, job_id, user_id):
+                return result
+            progress("Sending your itinerary and finishing your Google Calendar...")
+            # Send the email with trip details while the remaining calendar events are being written
+            delivery_started = time.perf_counter()
+            _, failures = await asyncio.gather(
+                send_email(client, my_trip, result),
+                calendar.wait() if calendar is not None else asyncio.sleep(0, result=[]),
+            )
+            METRICS.observe("stage_duration_seconds", time.perf_counter() - delivery_started, stage="delivery")
+            if calendar is None:
+                log.info("Calendar file ready for download.")
+            elif failures:
+                log.warning(f"{len(failures)} of {result['event_count']} calendar events could not be added.")
+            else:
+                log.info("Calendar events added successfully.")
+            result["calendar_failures"] = len(failures)
+        return result
     except Exception as e:
-        print(f"Error processing trip: {e}")
-        print(f"Error type: {type(e)}")
-        traceback.print_exc()
+        log.exception(f"Error processing trip ({type(e).__name__}): {e}")
+        await withdraw_calendar_events(calendar, enqueued, job_id)
         raise e
+    finally:
+        # Never leave calendar writes (or outbox inserts) running in the background
+        if calendar is not None:
+            await calendar.wait()
+        await asyncio.gather(*enqueued, return_exceptions=True)
 
-def get_anthropic_plan(trip):
-    # Validate input information
-    if not all([trip.start_location, trip.travel_location, trip.arrival_date, trip.departure_date]):
-        raise ValueError("Missing required trip information")
-    print("Validated trip information successfully.")
-    # Define the tool for structured output
-    tools = [{
-        "name": "travel_events",
-        "description": "A comprehensive list of events for the trip itinerary.",
-        "input_schema": {
-            "type": "object",
-            "properties": {
-                "events": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "event_name": {"type": "string"},
-                            "event_time": {"type": "string"},
-                            "event_price": {"type": "string"},
-                            "event_address": {"type": "string"},
-                            "event_description": {"type": "string"}
-                        },
-                        "required": ["event_name", "event_address", "event_time"],
-                        "additionalProperties": False
-                    }
+async def withdraw_calendar_events(calendar, enqueued, job_id):
+    # A failed plan must not leave the events it already wrote (or queued) in the user's calendar
+    try:
+        if calendar is not None:
+            await calendar.rollback()
+        elif enqueued:
+            await asyncio.gather(*enqueued, return_exceptions=True)
+            await asyncio.to_thread(OUTBOX.cancel_job, job_id)
+    except Exception as e:
+        log.exception(f"Could not remove the calendar events of a failed trip: {e}")
+
+async def finish_plan(my_trip, result, job_id, user_id):
+    """
+    Logs the new itinerary and links its calendar file. With the outbox on, also queues the email
+    and returns True: the trip is done and everything else is delivered in the background.
+    """
+    # Show some event names on the Terminal
+    log.info(f"Generated itinerary with {result['event_count']} events")
+    log.debug("First few events:")
+    for i, event in enumerate(result["itinerary"][:3]):
+        log.debug(f"  Event {i+1}: {event.event_name}")
+    # Link the trip's calendar file in the email when we know our public address
+    if job_id and CALENDAR_FILES is not None:
+        ics = build_trip_ics(my_trip, result["itinerary"], uid_prefix=job_id)
+        await asyncio.to_thread(CALENDAR_FILES.save, job_id, my_trip, ics)
+        result["calendar_url"] = f"{PUBLIC_BASE_URL}/trip_results/{job_id}/itinerary.ics"
+    if OUTBOX is None:
+        return False
+    # The plan is done; the email (and any calendar events still queued) go out in the background
+    await asyncio.to_thread(OUTBOX.enqueue_many, job_id, user_id, [("Gmail.SendEmail", email_tool_input(my_trip, result))])
+    result["delivery"] = "queued"
+    log.info("Email and calendar updates queued for delivery.")
+    return True
+
+# Define the tool for structured output
+TOOLS = [{
+    "name": "travel_events",
+    "description": "A comprehensive list of events for the trip itinerary.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "events": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "event_name": {"type": "string"},
+                        "event_time": {"type": "string"},
+                        "event_price": {"type": "string"},
+                        "event_address": {"type": "string"},
+                        "event_description": {"type": "string"}
+                    },
+                    "required": ["event_name", "event_address", "event_time"],
+                    "additionalProperties": False
                 }
-            },
-            "required": ["events"],
-            "additionalProperties": False
-        }
-    }]
+            }
+        },
+        "required": ["events"],
+        "additionalProperties": False
+    }
+}]
+
+# What one itinerary event must look like (see ItineraryEvent)
+EVENT_SCHEMA = TOOLS[0]["input_schema"]["properties"]["events"]["items"]
+EVENT_FIELDS = tuple(EVENT_SCHEMA["properties"])
+EVENT_REQUIRED_FIELDS = tuple(EVENT_SCHEMA["required"])
+
+# Providing more background for the LLM
+# Not marked for prompt caching: even with the tool schema and every fixed line of the prompt templates, the static
+# prefix is a few hundred tokens, below the 1024 tokens Claude Sonnet needs before it caches anything
+SYSTEM_PROMPT = [{
+    "type": "text",
+    "text": "You are an expert travel planner with years of experience creating unforgettable trips. You specialize in comprehensive, detailed itineraries that include practical information like dates, locations, and costs. Always use the provided tool to structure your response with well-organized itinerary data.",
+}]
 
-    print("Tool schema defined successfully.")
-    
-    # Prompt specific to the Flight Travel Style (includes airport codes, plane times, etc.)
-    prompt_flight = f"""Create a travel itinerary for {trip.passenger_adult_count} adults from {trip.start_location} to {trip.travel_location} from {trip.arrival_date} to {trip.departure_date}.
+# Prompt specific to the Flight Travel Style (includes airport codes, plane times, etc.)
+PROMPT_FLIGHT = """Create a travel itinerary for {adults} adults from {start_location} to {travel_location} from {arrival_date} to {departure_date}.
 
-        Travel style: {trip.travel_style}
-        Preferences: {trip.travel_preferences}
+        Travel style: {travel_style}
+        Preferences: {travel_preferences}
 
         These events MUST include: flights, hotels, fun activities, and delicious restaurants for all three meals. 
         Would recommend parks, districts, and other places of interest that are not tourist traps.
@@ -323,12 +1926,12 @@ def get_anthropic_plan(trip):
         Use the travel_events tool to structure your response. 
         """
 
-    # Prompt specific to the Driving Travel Style (includes gas stations or electrical vehicle charging stations)
-    prompt_road_trip = f"""Create a travel itinerary for {trip.passenger_adult_count} adults from {trip.start_location} to {trip.travel_location} from {trip.arrival_date} to {trip.departure_date}.
+# Prompt specific to the Driving Travel Style (includes gas stations or electrical vehicle charging stations)
+PROMPT_ROAD_TRIP = """Create a travel itinerary for {adults} adults from {start_location} to {travel_location} from {arrival_date} to {departure_date}.
 
-        Travel style: {trip.travel_style}
-        Car type: {trip.car_type}
-        Preferences: {trip.travel_preferences}
+        Travel style: {travel_style}
+        Car type: {car_type}
+        Preferences: {travel_preferences}
 
         These events MUST include: gas stations or electrical vehicle charging stations depending on car type, hotels, fun activities, and delicious restaurants for all three meals. 
         Would recommend parks, districts, and other places of interest that are not tourist traps.
@@ -337,238 +1940,628 @@ def get_anthropic_plan(trip):
         Use the travel_events tool to structure your response.
         """
 
+# Token usage reported by Anthropic
+TOKEN_USAGE_STATS = {
+    "requests": 0,
+    "input_tokens": 0,
+    "output_tokens": 0,
+}
+TOKEN_USAGE_STATS_LOCK = threading.Lock()
+
+# Per-day planning: transport and lodging first, then each day on its own
+PROMPT_SKELETON = """Plan only the backbone of a trip for {adults} adults from {start_location} to {travel_location} from {arrival_date} to {departure_date}.
+
+        Travel style: {travel_style}
+        Car type: {car_type}
+        Preferences: {travel_preferences}
+
+        These events MUST include ONLY: {transport}, and hotel check-in and check-out. Do not include meals or activities.
+        Would prefer one emoji per event name.
+        Please put event time in ISO format. 
+        Use the travel_events tool to structure your response.
+        """
+
+PROMPT_DAY = """Plan day {day_number} of {day_count} ({day}) of a trip for {adults} adults from {start_location} visiting {travel_location}.
+
+        Travel style: {travel_style}
+        Preferences: {travel_preferences}
+        Transport and lodging already planned (do not repeat these):
+{booked}
+
+        These events MUST include: fun activities, and delicious restaurants for all three meals, on {day} only. 
+        Would recommend parks, districts, and other places of interest that are not tourist traps.
+        Would prefer one emoji per event name.
+        Please put event time in ISO format. 
+        Use the travel_events tool to structure your response.
+        """
+
+def build_prompt(trip):
+    # Specific prompts for each option (flying is the default fallback option)
+    template = PROMPT_ROAD_TRIP if trip.travel_style == "Driving" else PROMPT_FLIGHT
+    return template.format(
+        adults=trip.passenger_adult_count,
+        start_location=trip.start_location,
+        travel_location=trip.travel_location,
+        arrival_date=trip.arrival_date,
+        departure_date=trip.departure_date,
+        travel_style=trip.travel_style,
+        car_type=trip.car_type,
+        travel_preferences=trip.travel_preferences,
+    )
+
+def build_skeleton_prompt(trip):
+    if trip.travel_style == "Driving":
+        transport = "the drive, with gas stations or electrical vehicle charging stations depending on car type"
+    else:
+        transport = "flights"
+    return PROMPT_SKELETON.format(
+        adults=trip.passenger_adult_count,
+        start_location=trip.start_location,
+        travel_location=trip.travel_location,
+        arrival_date=trip.arrival_date,
+        departure_date=trip.departure_date,
+        travel_style=trip.travel_style,
+        car_type=trip.car_type,
+        travel_preferences=trip.travel_preferences,
+        transport=transport,
+    )
+
+def build_day_prompt(trip, day, day_number, day_count, booked):
+    return PROMPT_DAY.format(
+        day=day,
+        day_number=day_number,
+        day_count=day_count,
+        adults=trip.passenger_adult_count,
+        start_location=trip.start_location,
+        travel_location=trip.travel_location,
+        travel_style=trip.travel_style,
+        travel_preferences=trip.travel_preferences,
+        booked=booked or "        - (none)",
+    )
+
+def record_token_usage(usage):
+    if usage is None:
+        return
+    with TOKEN_USAGE_STATS_LOCK:
+        TOKEN_USAGE_STATS["requests"] += 1
+        for field in ("input_tokens", "output_tokens"):
+            TOKEN_USAGE_STATS[field] += getattr(usage, field, None) or 0
+    log.debug(f"Token usage: {usage.input_tokens} input, {usage.output_tokens} output")
+
+async def get_anthropic_plan(trip, anthropic_client, on_event=None, deadline=None):
+    from anthropic import RateLimitError
+    from anthropic._exceptions import OverloadedError
+    # Validate input information
+    if not all([trip.start_location, trip.travel_location, trip.arrival_date, trip.departure_date]):
+        raise ValueError("Missing required trip information")
+    log.debug("Validated trip information successfully.")
+
     # Ensure responses adhere to JSON format
     try:
-        # Specific prompts for each option 
-        if trip.travel_style == "Flying":
-            prompt = prompt_flight
-        elif trip.travel_style == "Driving":
-            prompt = prompt_road_trip
-        # Default fallback option
+        if PLANNER_MODE == "per_day":
+            events = await get_per_day_events(trip, anthropic_client, on_event=on_event, deadline=deadline)
         else:
-            prompt = prompt_flight 
-
-        print("Generating travel plan using Anthropic API...")
-
-        # Make the API call to Claude
-        response = anthropic_client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4000,
-            temperature=0.7,
-            # Providing more background for the LLM
-            system="You are an expert travel planner with years of experience creating unforgettable trips. You specialize in comprehensive, detailed itineraries that include practical information like dates, locations, and costs. Always use the provided tool to structure your response with well-organized itinerary data.",
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            tools=tools,
-            tool_choice={"type": "tool", "name": "travel_events"}
-        )
-        print("Anthropic API call completed successfully.")
-
-        print(f"Response type: {type(response)}")
-        print(f"Response content: {response.content}")
-
-        # Parse Response to return a dictionary
-        if response.content: 
-            # Check if the response contains tool calls and valid arguments
-            for content_block in response.content:
-                if content_block.type == "tool_use" and content_block.name == "travel_events":
-                    itinerary_data = content_block.input
-                    print("Itinerary data extracted successfully.")
-
-                    # Handle different possible response structures
-                    events = None
-                    if "events" in itinerary_data:
-                        events = itinerary_data["events"]
-                    elif "itinerary" in itinerary_data:
-                        events = itinerary_data["itinerary"]
-                    else:
-                        # If neither key exists, try to use the whole data as events
-                        print("Warning: Expected 'events' key not found in response")
-                        print(f"Available keys: {list(itinerary_data.keys())}")
-                        # Try to find any array-like structure
-                        for key, value in itinerary_data.items():
-                            if isinstance(value, list):
-                                events = value
-                                print(f"Using '{key}' as events array")
-                                break
-
-                    return {
-                        "itinerary": itinerary_data["events"],
-                        "event_count": len(itinerary_data["events"]),
-                        "model_used": "claude-sonnet-4-20250514"
-                    }
-            print("No valid tool use found in the response.")
-            # If no tool use found, return text content if available
-            text_content = ""
-            for content_block in response.content:
-                if content_block.type == "text":
-                    text_content += content_block.text
-            print("Text content from response:", text_content)
+            log.info("Generating travel plan using Anthropic API...")
+            events = await request_travel_events(anthropic_client, build_prompt(trip), on_event=on_event, deadline=deadline)
+        if events is None:
             return None
-    except OverloadedError:
-        print("Anthropic API is currently overloaded. Please try again in a few minutes.")
+        return {
+            "itinerary": events,
+            "event_count": len(events),
+            "model_used": CLAUDE_MODEL
+        }
+    except (OverloadedError, RateLimitError, CircuitOpenError) as e:
+        log.warning("Anthropic API is currently overloaded. Please try again in a few minutes.")
+        METRICS.inc("errors_total", stage="claude", error=type(e).__name__)
         return None
     # Handle any exceptions that occur during the API call
     except Exception as e:
-        print(f"Error in Anthropic API call: {e}")
-        traceback.print_exc()
+        log.exception(f"Error in Anthropic API call: {e}")
+        METRICS.inc("errors_total", stage="claude", error=type(e).__name__)
         return None
 
-def send_email(trip, result):
+async def request_travel_events(anthropic_client, prompt, on_event=None, deadline=None, max_tokens=4000):
+    """
+    Makes one travel_events call to Claude (cached, guarded and optionally streamed) and returns its valid
+    events as ItineraryEvents in time order, or None when Claude did not use the tool.
+    """
+    request_params = travel_events_request(prompt, max_tokens)
+
+    # Identical requests reuse the events we already generated
+    cache_key = ITINERARY_CACHE.make_key(request_params)
+    cached = await replay_cached_events(cache_key, on_event)
+    if cached is not None:
+        return cached
+    collector = EventCollector(on_event)
+
+    async def call_claude(timeout):
+        # Never wait on Claude past the trip's deadline (nor past the client's own timeout)
+        params = request_params if timeout is None else dict(request_params, timeout=min(timeout, CLIENTS.anthropic_timeout))
+        if STREAM_ITINERARY:
+            return await stream_anthropic_plan(anthropic_client, params, collector.accept)
+        return await anthropic_client.messages.create(**params), 0
+
+    # Limited, retried and circuit-broken (see ClaudeGuard)
+    with METRICS.timer("stage_duration_seconds", stage="claude_call"):
+        response, emitted = await CLAUDE_GUARD.call(call_claude, deadline=deadline)
+    events = collector.finish(response, emitted)
+    if cacheable(response, events):
+        # The SQLite tier (if any) is written off the event loop
+        await asyncio.to_thread(ITINERARY_CACHE.set, cache_key, events)
+    return events
+
+def cacheable(response, events):
+    # Only complete itineraries are reused: not ones cut off at max_tokens, nor ones where every event was invalid
+    return bool(events) and response.stop_reason == "tool_use"
+
+def travel_events_request(prompt, max_tokens):
+    # Parameters of the Claude call (also what the itinerary cache is keyed by)
+    return dict(
+        model=CLAUDE_MODEL,
+        max_tokens=max_tokens,
+        temperature=0.7,
+        system=SYSTEM_PROMPT,
+        messages=[
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        tools=TOOLS,
+        tool_choice={"type": "tool", "name": "travel_events"}
+    )
+
+async def replay_cached_events(cache_key, on_event):
+    cached = await asyncio.to_thread(ITINERARY_CACHE.get, cache_key)
+    if cached is not None and on_event:
+        for event in cached:
+            on_event(event)
+    return cached
+
+class EventCollector:
+    """
+    Checks raw travel_events output against the tool schema once, as it arrives (from the stream or
+    the final message), keeps the valid events and hands each one to `on_event`.
+    """
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.events = []
+
+    def accept(self, raw_event):
+        try:
+            event = ItineraryEvent.from_dict(raw_event)
+        except InvalidEventError as e:
+            log.warning(f"Dropping invalid itinerary event ({e}): {raw_event!r:.200}")
+            return
+        self.events.append(event)
+        if self.on_event:
+            self.on_event(event)
+
+    def finish(self, response, emitted):
+        """
+        Reads the events out of Claude's response (accepting those the stream did not already deliver)
+        and returns every valid one in time order, or None when Claude did not use the tool.
+        """
+        log.debug("Anthropic API call completed successfully.")
+        record_token_usage(response.usage)
+
+        log.debug(f"Response blocks: {[content_block.type for content_block in response.content]}")
+
+        # Check if the response contains tool calls and valid arguments
+        for content_block in response.content:
+            if content_block.type == "tool_use" and content_block.name == "travel_events":
+                itinerary_data = content_block.input
+                log.debug("Itinerary data extracted successfully.")
+
+                # Handle different possible response structures
+                raw_events = None
+                if "events" in itinerary_data:
+                    raw_events = itinerary_data["events"]
+                elif "itinerary" in itinerary_data:
+                    raw_events = itinerary_data["itinerary"]
+                else:
+                    # If neither key exists, try to use the whole data as events
+                    log.warning("Expected 'events' key not found in response")
+                    log.warning(f"Available keys: {list(itinerary_data.keys())}")
+                    # Try to find any array-like structure
+                    for key, value in itinerary_data.items():
+                        if isinstance(value, list):
+                            raw_events = value
+                            log.warning(f"Using '{key}' as events array")
+                            break
+                if not isinstance(raw_events, list):
+                    log.warning("No events array found in the response.")
+                    return None
+
+                # Check (and hand over) any events the stream did not already deliver
+                for raw_event in raw_events[emitted:]:
+                    self.accept(raw_event)
+                return sorted(self.events, key=ItineraryEvent.sort_key)
+        log.warning("No valid tool use found in the response.")
+        # If no tool use found, return text content if available
+        text_content = ""
+        for content_block in response.content:
+            if content_block.type == "text":
+                text_content += content_block.text
+        log.debug(f"Text content from response: {text_content}")
+        return None
+
+async def get_per_day_events(trip, anthropic_client, on_event=None, deadline=None):
+    """
+    Plans a trip in parallel: one call for the transport and lodging skeleton, then one call per day
+    (run concurrently, PLAN_DAY_CONCURRENCY at a time), merged and de-duplicated into a single time-ordered event list.
+    """
+    emit = unique_events(on_event)
+    log.info("Generating trip skeleton using Anthropic API...")
+    skeleton = await request_travel_events(anthropic_client, build_skeleton_prompt(trip), on_event=emit, deadline=deadline, max_tokens=2000)
+    if skeleton is None:
+        return None
+    booked = "\n".join(f"        - {event.event_time}: {event.event_name}" for event in skeleton)
+
+    days = trip_days(trip)
+    log.info(f"Generating {len(days)} days in parallel...")
+    day_slots = asyncio.Semaphore(PLAN_DAY_CONCURRENCY)
+
+    async def plan_day(day_number, day):
+        async with day_slots:
+            prompt = build_day_prompt(trip, day, day_number, len(days), booked)
+            return await request_travel_events(anthropic_client, prompt, on_event=emit, deadline=deadline, max_tokens=2000)
+
+    day_events = await asyncio.gather(*(plan_day(day_number, day) for day_number, day in enumerate(days, start=1)))
+    # Every day has to be planned for the itinerary to be usable
+    if any(events is None for events in day_events):
+        log.warning("At least one day could not be planned.")
+        return None
+    return merge_events(skeleton, *day_events)
+
+def trip_days(trip):
+    return [trip.arrival_date + timedelta(days=i) for i in range((trip.departure_date - trip.arrival_date).days + 1)]
+
+def unique_events(on_event):
+    # The same event can come back from more than one call; only hand it over once
+    seen = set()
+
+    def emit(event):
+        key = event_key(event)
+        if key in seen:
+            return
+        seen.add(key)
+        if on_event:
+            on_event(event)
+    return emit
+
+def event_key(event):
+    # Events match when their names (ignoring emoji, case and punctuation) and times match
+    name = "".join(char for char in event.event_name.casefold() if char.isalnum())
+    return name, event.event_time
+
+def merge_events(*event_lists):
+    # Combine, drop duplicates and order by time (events without a readable time go last)
+    merged = {}
+    for events in event_lists:
+        for event in events:
+            merged.setdefault(event_key(event), event)
+    return sorted(merged.values(), key=ItineraryEvent.sort_key)
+
+async def stream_anthropic_plan(anthropic_client, request_params, on_event=None):
+    """
+    Streams the Claude response, passing each travel event to `on_event` as soon as it is complete.
+    Returns the final message and how many events were already delivered.
+    """
+    parser = TravelEventsParser(on_event or (lambda event: None))
     try:
-        print("Sending email with trip details...")
-        # Request access to the user's Gmail account
-        auth_response = client.tools.authorize(
-        tool_name="Gmail.SendEmail",
-        user_id=USER_ID,
-        ) 
-
-        if auth_response.status != "completed":
-            print(f"Click this link to authorize: {auth_response.url}")
-
-        # Wait for authorization
-        client.auth.wait_for_completion(auth_response)
-        print("Email authorization completed successfully.")
-        
-        email_content = get_email_content(trip, result)
+        async with anthropic_client.messages.stream(**request_params) as stream:
+            async for stream_event in stream:
+                if stream_event.type == "input_json":
+                    parser.feed(stream_event.partial_json)
+            response = await stream.get_final_message()
+    except Exception as e:
+        # Events already went to the calendar, so a retry would duplicate them
+        if parser.emitted:
+            raise StreamInterruptedError(f"Itinerary stream failed after {parser.emitted} events: {e}") from e
+        raise
+    log.debug(f"Streamed {parser.emitted} events")
+    return response, parser.emitted
 
-        # Inputs for the tool 
-        tool_input = {
-            "subject" : "Your Upcoming Trip to " + trip.travel_location, 
-            "body" : email_content,
-            "recipient": USER_ID,
-        }
-        
-        # Executing the tool
-        emails_response = client.tools.execute(
-            tool_name="Gmail.SendEmail",
-            input=tool_input,
-            user_id=USER_ID,
-        )
-        print("Email sent successfully:", emails_response.output.value)
+async def send_email(client, trip, result):
+    user_id = trip.user_email
+    try:
+        log.info("Sending email with trip details...")
+        # Executing the tool (the Gmail authorization is cached after the first time)
+        emails_response = await execute_tool(client, user_id, "Gmail.SendEmail", email_tool_input(trip, result))
+        log.info(f"Email sent successfully: {emails_response.output.value}")
     except ValueError as ve:
-        print(f"ValueError: {ve}")
-        traceback.print_exc()
+        log.exception(f"ValueError: {ve}")
         return None
     except Exception as e:
-        print(f"Error sending email: {e}")
-        traceback.print_exc()
+        log.exception(f"Error sending email: {e}")
         return None
-    
-def get_email_content(trip, result):
+
+def email_tool_input(trip, result):
+    # Inputs for the tool 
+    tool_input = {
+        "subject" : "Your Upcoming Trip to " + trip.travel_location, 
+        "body" : render_email(trip, result),
+        "recipient": trip.user_email,
+    }
+    if EMAIL_FORMAT == "html":
+        tool_input["content_type"] = "html"
+    return tool_input
+
+def render_email(trip, result):
+    with METRICS.timer("stage_duration_seconds", stage="email_render"):
+        return get_email_content(trip, result, html=EMAIL_FORMAT == "html")
+
+def get_email_content(trip, result, html=False):
+    """
+    Renders the itinerary email (plain text, or HTML when `html` is set) in a single pass over the events.
+    Takes ItineraryEvents; events without a price or description just leave those lines out.
+    """
     try:
-        print("Generating email content...")
-        # Create the email content
-        email_content = f"""
-Hi,
-
-Here is your travel itinerary for your upcoming trip from {trip.start_location} to {trip.travel_location}.
-
-Trip Details:
-- Arrival Date: {trip.arrival_date}
-- Departure Date: {trip.departure_date}
-- Travel Preferences: {trip.travel_preferences}
-
-Itinerary:
-    """
-        # Initalize Dictionary for event details
-        event_details = []
-        # Populate event details with result from the API call
-        for event in result["itinerary"]:
-            event_details.append({
-                "name": event["event_name"],
-                "time": event["event_time"],
-                "price": event["event_price"],
-                "address": event["event_address"],
-                "description": event["event_description"]
-            })
-
-        # Format the event details into the email content
-        for i, event in enumerate(event_details, start=1):
-            email_content += f"""
-            Event {i}:
-            - Name: {event['name']}
-            - Time: {event['time']}
-            - Price: {event['price']}
-            - Address: {event['address']}
-            - Description: {event['description']}
-            """
-
-        email_content += "\n\nWishing you all the best with your upcoming trip. Safe travels!\n"
-        
-        print("Email content generated successfully.")
+        log.debug("Generating email content...")
+        template = EMAIL_TEMPLATES.get("itinerary.html" if html else "itinerary.txt")
+        email_content = template.render(
+            trip=trip,
+            events=result["itinerary"],
+            calendar_url=result.get("calendar_url"),
+        )
+        log.debug("Email content generated successfully.")
         return email_content
     except Exception as e:
         raise ValueError(f"Error generating email content: {e}")
+
+class EmailTemplates:
+    """
+    Jinja templates for the itinerary email (templates/email/), compiled on first use and then
+    reused by every thread. Rendering works outside a Flask request, e.g. from the outbox dispatcher.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self._templates = {}
+        self._lock = threading.Lock()
+        self._environment = None
+
+    def get(self, name):
+        template = self._templates.get(name)
+        if template is None:
+            with self._lock:
+                if self._environment is None:
+                    import jinja2
+                    self._environment = jinja2.Environment(
+                        loader=jinja2.FileSystemLoader(self.folder),
+                        autoescape=jinja2.select_autoescape(["html"]),
+                        trim_blocks=True,
+                        lstrip_blocks=True,
+                        keep_trailing_newline=True,
+                    )
+                template = self._templates[name] = self._environment.get_template(name)
+        return template
+
+EMAIL_TEMPLATES = EmailTemplates(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "email"))
         
-def add_calendar_event(client, event):
+class CalendarWriter:
+    """
+    Adds itinerary events to the user's calendar as they are submitted: each event is a task on the running
+    event loop and at most `max_workers` of them write at the same time.
+    wait() returns once every write is done, with the (event, error) pairs that failed;
+    rollback() deletes the events that were added.
+    """
+    def __init__(self, client, user_id, max_workers=None):
+        self.client = client
+        self.user_id = user_id
+        self._slots = asyncio.Semaphore(max_workers or CALENDAR_CONCURRENCY)
+        self._tasks = {}
+        self._failures = None
+        self._created = []
+
+    def submit(self, event):
+        self._tasks[asyncio.ensure_future(self._add(event))] = event
+
+    async def _add(self, event):
+        async with self._slots:
+            return await add_calendar_event(self.client, event, self.user_id)
+
+    async def wait(self):
+        if self._failures is None:
+            failures = []
+            results = await asyncio.gather(*self._tasks, return_exceptions=True)
+            for event, outcome in zip(self._tasks.values(), results):
+                if isinstance(outcome, Exception):
+                    log.warning(f"Error adding calendar event '{event.event_name}': {outcome}")
+                    failures.append((event, outcome))
+                else:
+                    self._created.append(created_event_id(outcome))
+            self._failures = failures
+        return self._failures
+
+    async def rollback(self):
+        # Takes the events this writer added back out of the calendar (the trip they belong to failed)
+        await self.wait()
+        outcomes = await asyncio.gather(*(self._delete(event_id) for event_id in self._created), return_exceptions=True)
+        left = sum(1 for event_id, outcome in zip(self._created, outcomes) if event_id is None or isinstance(outcome, Exception))
+        if left:
+            log.warning(f"{left} of {len(self._created)} calendar events of a failed trip could not be removed.")
+
+    async def _delete(self, event_id):
+        if event_id is not None:
+            async with self._slots:
+                await execute_tool(self.client, self.user_id, "GoogleCalendar.DeleteEvent", delete_calendar_event_input(event_id))
+
+async def add_calendar_events(client, events, user_id, max_workers=None):
+    """
+    Adds every itinerary event to the user's calendar, at most `max_workers` at a time.
+    Returns a list of (event, error) pairs for the events that could not be added.
+    """
+    calendar = CalendarWriter(client, user_id, max_workers)
+    for event in events:
+        calendar.submit(event)
+    return await calendar.wait()
+
+async def add_calendar_event(client, event, user_id):
+    # Call Arcade to add a calendar event (errors are raised to the caller)
+    return await execute_tool(client, user_id, "GoogleCalendar.CreateEvent", calendar_tool_input(event, user_id))
+
+def calendar_tool_input(event, user_id):
+    # Prepare the tool input for the calendar event
+    return {
+        "summary": event.event_name,
+        "description": event.event_description,
+        "start_datetime": event.event_time,
+        "end_datetime": event.event_time,  # Adjust as needed
+        "location": event.event_address,
+        "attendees": [user_id],
+        "calendar_id": "primary",
+    }
+
+def created_event_id(response):
+    # ID of the event a GoogleCalendar.CreateEvent call created ({"event": {"id": ...}}), or None when it is missing
+    value = getattr(getattr(response, "output", None), "value", None)
+    event = value.get("event", value) if isinstance(value, dict) else None
+    return event.get("id") if isinstance(event, dict) else None
+
+def delete_calendar_event_input(event_id):
+    # Without notifying anyone: the user is the only attendee of the events we add
+    return {"event_id": event_id, "send_updates": "none"}
+
+async def execute_tool(client, user_id, tool_name, tool_input):
+    # Authorization is shared by every call of this user (and by concurrent calls still waiting on it)
+    await TOOL_AUTH_CACHE.authorize(client, user_id, tool_name)
     try:
-        # Call Arcade to add a calendar event
-        TOOL_NAME = "GoogleCalendar.CreateEvent"
-        auth_response = client.tools.authorize(
-        tool_name=TOOL_NAME,
-        user_id=USER_ID,
-        )
+        async with CLIENTS.arcade_slots():
+            with METRICS.timer("tool_execution_seconds", tool=tool_name):
+                return await client.tools.execute(
+                    tool_name=tool_name,
+                    input=tool_input,
+                    user_id=user_id,
+                )
+    except Exception:
+        METRICS.inc("errors_total", stage="tool_execution", tool=tool_name)
+        # The cached authorization may be stale -> check it again next time
+        TOOL_AUTH_CACHE.invalidate(user_id, tool_name)
+        raise
 
-        if auth_response.status != "completed":
-            print(f"Click this link to authorize: {auth_response.url}")
-
-        # Wait for the authorization to complete
-        client.auth.wait_for_completion(auth_response)
-        print("Calendar authorization completed successfully.")
-
-        # Prepare the tool input for the calendar event
-        tool_input = {
-            "summary": event["event_name"],
-            "description": event["event_description"],
-            "start_datetime": event["event_time"],
-            "end_datetime": event["event_time"],  # Adjust as needed
-            "location": event["event_address"],
-            "attendees": [USER_ID],
-            "calendar_id": "primary",
-        }
-        client.tools.execute(
-            tool_name=TOOL_NAME,
-            input=tool_input,
-            user_id=USER_ID,
+async def authorize_tool(client, user_id, tool_name, wait=True):
+    # Request access to the user's account for this tool
+    async with CLIENTS.arcade_slots():
+        auth_response = await client.tools.authorize(
+        tool_name=tool_name,
+        user_id=user_id,
         )
-    except Exception as e:
-        print(f"Error adding calendar event: {e}")
-        traceback.print_exc()
+
+    if auth_response.status != "completed":
+        if not wait:
+            raise AuthorizationPendingError(tool_name, auth_response.url)
+        log.info(f"Click this link to authorize: {auth_response.url}")
+
+        # Wait for the authorization to complete (already-authorized users skip the wait)
+        await client.auth.wait_for_completion(auth_response)
+    log.info(f"{tool_name} authorization completed successfully.")
+
+# Calendar file defaults for events without a usable next event to end at
+ICS_DEFAULT_DURATION = timedelta(hours=1)
+ICS_MAX_DURATION = timedelta(hours=4)
+
+def parse_event_time(value):
+    # Claude is asked for ISO format; anything else cannot be placed on a calendar
+    try:
+        return datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
         return None
 
+def _ics_escape(text):
+    return str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\r\n", "\\n").replace("\n", "\\n")
+
+def _ics_time(value):
+    # Times with an offset are written in UTC, the rest as floating local times
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    return value.strftime("%Y%m%dT%H%M%S")
+
+def _ics_fold(line):
+    # Lines longer than 75 octets continue on the next line after a single space
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    while encoded:
+        cut = min(len(encoded), 75 if not parts else 74)
+        # Never split a multi-byte character
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode("utf-8"))
+        encoded = encoded[cut:]
+    return "\r\n ".join(parts)
+
+def build_trip_ics(trip, events, uid_prefix):
+    """
+    Builds one iCalendar document for the whole trip. Events are sorted by time and each one
+    ends when the next begins (capped at ICS_MAX_DURATION, or ICS_DEFAULT_DURATION for the last).
+    """
+    timed = []
+    for event in sorted(events, key=ItineraryEvent.sort_key):
+        if event.start is None:
+            log.warning(f"Skipping calendar entry with unreadable time: {event.event_name}")
+            continue
+        timed.append((event.start, event))
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//AI Travel Agent//Trip Itinerary//EN",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        "X-WR-CALNAME:" + _ics_escape(f"Trip to {trip.travel_location}"),
+    ]
+    for i, (start, event) in enumerate(timed):
+        end = start + ICS_DEFAULT_DURATION
+        if i + 1 < len(timed):
+            next_start = timed[i + 1][0]
+            # Only compare times of the same kind (both floating or both with an offset)
+            if (next_start.tzinfo is None) == (start.tzinfo is None) and start < next_start:
+                end = min(next_start, start + ICS_MAX_DURATION)
+        description = event.event_description
+        if event.event_price:
+            description = f"{description}\nPrice: {event.event_price}".strip()
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{uid_prefix}-{i}@ai-travel-agent",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART:{_ics_time(start)}",
+            f"DTEND:{_ics_time(end)}",
+            "SUMMARY:" + _ics_escape(event.event_name),
+            "LOCATION:" + _ics_escape(event.event_address),
+            "DESCRIPTION:" + _ics_escape(description),
+            "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(_ics_fold(line) for line in lines) + "\r\n"
+
+# Shared city index (built on the first validation; memory-maps cities.bin when setup.sh has compiled it)
+CITY_INDEX = CityIndex('cities.json', compiled_path='cities.bin')
+
 def validate_cities(from_city, to_city):
     try:
-        # Standardized to lowercase format 
-        from_city, to_city = from_city.lower(), to_city.lower()
-        # Parse the json file filled with all city names
-        with open('cities.json', 'r') as file:
-            data = json.load(file)
-            city_names = []
-            # Extract all city names into an array
-            for city in data:
-                name = city.get('name').lower()
-                city_names.append(name)
         # Validating the existence of these cities
-        if from_city in city_names and to_city in city_names:
-            print("Valid cities")
+        if from_city in CITY_INDEX and to_city in CITY_INDEX:
+            log.debug("Valid cities")
             return True
         else:
-            print("Invalid cities -> returning error")
+            log.warning("Invalid cities -> returning error")
             return False
     except FileNotFoundError:
-        print("Error: THe file 'data.json' was not found.")
+        log.error(f"Error: The file '{CITY_INDEX.path}' was not found.")
     except json.JSONDecodeError as e:
-        print(f"Error decoding JSON from file: {e}")
+        log.error(f"Error decoding JSON from file: {e}")
     except Exception as e:
-        print(f"Unexpected error occured: {e}")
-        traceback.print_exc()
+        log.exception(f"Unexpected error occured: {e}")
         return None
 
 if __name__ == "__main__":
     # Set up Flask
-    app.run(debug=True, host="0.0.0.0", port=2800) 
+    try:
+        app = create_app()
+    except ConfigError as e:
+        log.error(f"Error loading configuration: {e}")
+        sys.exit(1)
+    app.run(debug=True, host="0.0.0.0", port=2800)
@@ -0,0 +1,98 @@
+# In-process metrics (latency histograms and counters) exposed in the Prometheus text format
+#
+# Every server process keeps its own numbers; scrape each worker (or run one) to see all of them.
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds: from fast cache and SQLite hits up to multi-minute Claude calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Metrics:
+    """
+    Thread-safe registry of counters and histograms, keyed by metric name and label values.
+    Collectors add values that live elsewhere (e.g. cache hit counts) at scrape time.
+    """
+    def __init__(self, prefix, buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Per-bucket counts (made cumulative when rendered), then sum and count
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Records the block's duration even when it raises
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def add_collector(self, collect):
+        # `collect()` returns (name, kind, help, [(labels dict, value), ...]) tuples
+        self._collectors.append(collect)
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: ([*value[0]], value[1], value[2]) for key, value in self._histograms.items()}
+        lines = []
+        described = set()
+
+        def header(name, kind, help_text):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {self.prefix}{name} {help_text}")
+                lines.append(f"# TYPE {self.prefix}{name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, *self._help.get(name, ("counter", name)))
+            lines.append(f"{self.prefix}{name}{_labels(labels)} {_number(value)}")
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            header(name, *self._help.get(name, ("histogram", name)))
+            running = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                running += bucket_count
+                lines.append(f"{self.prefix}{name}_bucket{_labels(labels + (('le', _number(bound)),))} {running}")
+            lines.append(f"{self.prefix}{name}_sum{_labels(labels)} {_number(total)}")
+            lines.append(f"{self.prefix}{name}_count{_labels(labels)} {count}")
+        for collect in self._collectors:
+            for name, kind, help_text, samples in collect():
+                header(name, kind, help_text)
+                for labels, value in samples:
+                    lines.append(f"{self.prefix}{name}{_labels(tuple(sorted(labels.items())))} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
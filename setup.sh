@@ -40,6 +40,10 @@ fi
 # Unzip city data and rename
 unzip -p cities.zip > cities.json
 
+# Compile the city names into the compact, memory-mapped index used by the app
+echo "Building city index..."
+python cities.py cities.json cities.bin
+
 echo "Setup completed successfully!"
 echo "Steps to start:"
 echo "1. Edit the .env file to add your Arcade & Anthropic API key"